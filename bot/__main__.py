@@ -1,11 +1,20 @@
+import time
 import os
-import logging
-import json
 
-import discord
+# as early as possible, so that the startup report covers the imports below
+STARTED_AT = time.perf_counter()
 
-from bot.config import Config
-from bot.tk_bot import TKBot
+from bot.startup import ImportTimer, StartupReport  # noqa: E402
+
+import_timer = ImportTimer().install() if os.environ.get("BOT_PROFILE_IMPORTS") else None
+
+import logging  # noqa: E402
+import json  # noqa: E402
+
+import discord  # noqa: E402
+
+from bot.config import Config  # noqa: E402
+from bot.tk_bot import TKBot  # noqa: E402
 
 # Discord
 DISCORD_TOKEN = os.environ["DISCORD_TOKEN"]
@@ -16,10 +25,16 @@ DISCORD_SHARD_IDS = os.environ["DISCORD_SHARD_IDS"]
 BOT_PREFIX = os.environ["BOT_PREFIX"]
 BOT_VERSION = os.environ["BOT_VERSION"]
 BOT_LOG_LEVEL = os.environ["BOT_LOG_LEVEL"]
+# optional. each process needs its own port
+BOT_METRICS_PORT = os.environ.get("BOT_METRICS_PORT")
+# optional. the fraction of commands to log a timing trace of, from 0 to 1
+BOT_TRACE_SAMPLE_RATE = float(os.environ.get("BOT_TRACE_SAMPLE_RATE") or 0.01)
 
 if DISCORD_SHARD_COUNT:
     DISCORD_SHARD_COUNT = int(DISCORD_SHARD_COUNT)
 
+BOT_METRICS_PORT = int(BOT_METRICS_PORT) if BOT_METRICS_PORT else None
+
 if DISCORD_SHARD_IDS and json.loads(DISCORD_SHARD_IDS):
     DISCORD_SHARD_IDS = tuple(int(i) for i in json.loads(DISCORD_SHARD_IDS))
     assert DISCORD_SHARD_IDS
@@ -43,7 +58,25 @@ config = Config(
     user_agent='EmoteManagerBot (https://github.com/iomintz/emote-manager-bot)',
     ec_api_base_url=None,
     http_head_timeout=10,
-    http_read_timeout=60
+    http_read_timeout=60,
+    download_max_in_flight=32,
+    download_max_per_host=16,
+    download_max_per_guild=4,
+    image_worker_count=2,
+    image_worker_max_jobs=100,
+    image_processing_timeout=float('inf'),
+    image_cache_memory_limit=32 * 2**20,
+    image_cache_path=None,  # e.g. '/var/cache/emote_manager/images'
+    image_cache_disk_limit=512 * 2**20,
+    cdn_cache_memory_limit=64 * 2**20,
+    cdn_cache_path=None,  # e.g. '/var/cache/emote_manager/cdn'
+    cdn_cache_disk_limit=2 * 2**30,
+    defer_debug_extensions=True,
+    metrics_host='127.0.0.1',
+    metrics_port=BOT_METRICS_PORT,  # serves Prometheus metrics at /metrics if set
+    trace_sample_rate=BOT_TRACE_SAMPLE_RATE,  # see utils/tracing.py
+    # skip importing images the server already has. costs a CDN download of each of its emotes, once
+    dedupe_imports_against_guild=False,
 )
 
 # Handle intents, this needs to match the dashboard in the Discord developer application portal
@@ -74,6 +107,7 @@ bot = TKBot(
     activity=activity,
     shard_count=DISCORD_SHARD_COUNT,
     shard_ids=DISCORD_SHARD_IDS,
+    startup=StartupReport(STARTED_AT, import_timer=import_timer),
 )
 
 
@@ -81,15 +115,21 @@ def main():
     cogs = (
         'cogs.emote',
         'cogs.meta',
+        'cogs.metrics',
+        'bot_bin.systemd',
+    )
+    debug_cogs = (
         'bot_bin.debug',
         'bot_bin.misc',  # Ping & Uptime Command
-        'bot_bin.systemd',
         'jishaku',  # Debug Command
     )
-    for ext in cogs:
-        logging.info(f"Loading {ext}...")
-        bot.load_extension(ext)
-    logging.info(f"Found {len(cogs)} extensions. Running...")
+    if config.defer_debug_extensions:
+        bot.deferred_extensions = debug_cogs
+    else:
+        cogs += debug_cogs
+
+    bot.load_extensions(cogs)
+    logging.info(f"Found {len(cogs) + len(bot.deferred_extensions)} extensions. Running...")
     bot.run(DISCORD_TOKEN)
 
 
@@ -0,0 +1,4 @@
+# © lambda#0987 <lambda@lambda.dance>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+"""reproducible benchmarks for the bot's hot paths. Run them from the bot directory, e.g. python -m benchmarks.image"""
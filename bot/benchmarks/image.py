@@ -0,0 +1,304 @@
+# © lambda#0987 <lambda@lambda.dance>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+"""benchmark the utils.image pipeline against a synthetic corpus of images.
+
+usage: python -m benchmarks.image [--iterations N] [--mode inprocess|pool|oneshot ...] [--json]
+
+The corpus is generated from a fixed seed, so runs are comparable across commits.
+For each operation and image, latency percentiles and output sizes are reported,
+along with the peak RSS of this process (in-process modes) or of the image workers (subprocess modes).
+When more than one mode is run, each runs in a fresh copy of this script, so that their peak RSS don't mix.
+"""
+
+import argparse
+import asyncio
+import functools
+import io
+import json
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import time
+from typing import NamedTuple
+
+import wand.image
+
+import utils.image
+from utils import errors
+from utils.cache import ByteCache
+
+# (name, format, width, height, frames)
+CORPUS = (
+    ('png-small', 'png', 64, 64, 1),
+    ('png-medium', 'png', 512, 512, 1),
+    ('png-large', 'png', 1024, 1024, 1),
+    ('png-huge', 'png', 2048, 2048, 1),
+    ('jpeg-medium', 'jpeg', 512, 512, 1),
+    ('jpeg-large', 'jpeg', 2048, 2048, 1),
+    ('webp-medium', 'webp', 512, 512, 1),
+    ('webp-large', 'webp', 2048, 2048, 1),
+    ('gif-short', 'gif', 256, 256, 10),
+    ('gif-long', 'gif', 256, 256, 60),
+    ('gif-large', 'gif', 512, 512, 30),
+)
+
+MODES = ('inprocess', 'pool', 'oneshot')
+
+# runs python -m utils.image as usual, then reports the peak RSS of the process on the last line of stderr
+ONESHOT_MAIN = '''
+import atexit, resource, runpy, sys
+atexit.register(lambda: sys.stderr.write(f'\\n{resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}\\n'))
+runpy.run_module('utils.image', run_name='__main__', alter_sys=True)
+'''
+
+
+class Sample(NamedTuple):
+    name: str
+    data: bytes
+
+
+class Result(NamedTuple):
+    operation: str
+    mode: str
+    image: str
+    input_size: int
+    latencies: list
+    output_size: int
+    peak_rss: int
+
+
+def make_frame(rng, width, height):
+    """smooth-ish noise: coarse random pixels scaled up, which compresses about as well as a photo."""
+    coarse_width, coarse_height = max(width // 8, 1), max(height // 8, 1)
+    n = coarse_width * coarse_height * 3
+    pixels = rng.getrandbits(8 * n).to_bytes(n, 'little')
+    frame = wand.image.Image(width=coarse_width, height=coarse_height)
+    frame.import_pixels(width=coarse_width, height=coarse_height, channel_map='RGB', storage='char', data=pixels)
+    frame.resize(width, height)
+    return frame
+
+
+def make_sample(rng, name, format, width, height, frames):
+    with wand.image.Image() as image:
+        for _ in range(frames):
+            with make_frame(rng, width, height) as frame:
+                image.sequence.append(frame)
+        for frame in image.sequence:
+            frame.delay = 4
+        image.format = format
+        return Sample(name, image.make_blob())
+
+
+def make_corpus(seed):
+    rng = random.Random(seed)
+    return [make_sample(rng, *spec) for spec in CORPUS]
+
+
+def peak_rss_from_kib(ru_maxrss):
+    # ru_maxrss is in kibibytes on linux
+    return ru_maxrss * 1024
+
+
+def peak_rss(who=resource.RUSAGE_SELF):
+    return peak_rss_from_kib(resource.getrusage(who).ru_maxrss)
+
+
+def bench_sync(func, sample, iterations):
+    latencies = []
+    output = None
+    for _ in range(iterations):
+        start = time.perf_counter()
+        output = func(sample.data)
+        latencies.append(time.perf_counter() - start)
+    return latencies, output
+
+
+async def bench_async(func, sample, iterations):
+    latencies = []
+    output = None
+    for _ in range(iterations):
+        start = time.perf_counter()
+        output = await func(sample.data)
+        latencies.append(time.perf_counter() - start)
+    return latencies, output
+
+
+def in_process(func):
+    def run(data):
+        buf = io.BytesIO(data)
+        func(buf)
+        return buf.getvalue()
+    return run
+
+
+async def oneshot(command_name, data, *, peaks):
+    """the old way: a new interpreter for every image. its peak RSS is appended to peaks."""
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable, '-c', ONESHOT_MAIN, command_name,
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE)
+    out, err = await proc.communicate(data)
+    rest, _, rss = err.rstrip(b'\n').rpartition(b'\n')
+    # a child that crashed never got to report
+    if rss.isdigit():
+        peaks.append(peak_rss_from_kib(int(rss)))
+        err = rest
+    if proc.returncode == 2:
+        raise errors.InvalidImageError
+    if proc.returncode != 0:
+        raise RuntimeError(err.decode('utf-8') + f'Return code: {proc.returncode}')
+    return out
+
+
+def output_size(output):
+    # mime_type_for_image returns a short string, which isn't interesting
+    return len(output) if isinstance(output, (bytes, bytearray)) or len(output) > 32 else 0
+
+
+async def run_benchmarks(corpus, modes, iterations):
+    results = []
+
+    def record(operation, mode, sample, latencies, output, rss):
+        results.append(Result(
+            operation, mode, sample.name, len(sample.data), latencies, output_size(output), rss))
+
+    # these are always in-process since they never touch ImageMagick
+    for sample in corpus:
+        for operation, func in (
+            ('mime_type_for_image', utils.image.mime_type_for_image),
+            ('image_to_base64_url', utils.image.image_to_base64_url),
+        ):
+            latencies, output = bench_sync(func, sample, iterations)
+            record(operation, 'inprocess', sample, latencies, output, peak_rss())
+
+    # (operation, in-process function, worker pool function)
+    transforms = (
+        ('resize', utils.image.resize_until_small, utils.image.resize_in_subprocess),
+        ('convert', utils.image.convert_to_gif, utils.image.convert_to_gif_in_subprocess),
+    )
+
+    if 'inprocess' in modes:
+        for sample in corpus:
+            for operation, func, _ in transforms:
+                latencies, output = bench_sync(in_process(func), sample, iterations)
+                record(operation, 'inprocess', sample, latencies, output, peak_rss())
+
+    if 'pool' in modes:
+        # make sure that we measure the work, not the cache
+        utils.image.image_cache = ByteCache(memory_limit=0)
+        pool = utils.image.configure_worker_pool(size=1, max_jobs=float('inf'))
+        await pool.start()
+        try:
+            for sample in corpus:
+                for operation, _, func in transforms:
+                    latencies, output = await bench_async(func, sample, iterations)
+                    record(operation, 'pool', sample, latencies, output, None)
+        finally:
+            await pool.close()
+        # the workers have exited now, so their usage is visible
+        rss = peak_rss(resource.RUSAGE_CHILDREN)
+        results = [r._replace(peak_rss=rss) if r.mode == 'pool' else r for r in results]
+
+    if 'oneshot' in modes:
+        for sample in corpus:
+            for operation, _, _ in transforms:
+                # RUSAGE_CHILDREN would be the largest of every child so far, so each one reports its own
+                peaks = []
+                func = functools.partial(oneshot, operation, peaks=peaks)
+                latencies, output = await bench_async(func, sample, iterations)
+                record(operation, 'oneshot', sample, latencies, output, max(peaks, default=None))
+
+    return results
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return float('nan')
+    index = min(int(round(p / 100 * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def summarize(result):
+    latencies = sorted(result.latencies)
+    return {
+        'operation': result.operation,
+        'mode': result.mode,
+        'image': result.image,
+        'input_bytes': result.input_size,
+        'output_bytes': result.output_size,
+        'iterations': len(latencies),
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p90_ms': percentile(latencies, 90) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'mean_ms': statistics.mean(latencies) * 1000,
+        'peak_rss_bytes': result.peak_rss,
+    }
+
+
+def print_table(rows):
+    header = (
+        f'{"operation":<20} {"mode":<9} {"image":<12} {"input":>10} {"output":>10} '
+        f'{"p50 ms":>9} {"p90 ms":>9} {"p99 ms":>9} {"peak RSS":>11}')
+    sys.stdout.write(header + '\n')
+    sys.stdout.write('-' * len(header) + '\n')
+    for row in rows:
+        sys.stdout.write(
+            f'{row["operation"]:<20} {row["mode"]:<9} {row["image"]:<12} '
+            f'{row["input_bytes"]:>10} {row["output_bytes"]:>10} '
+            f'{row["p50_ms"]:>9.2f} {row["p90_ms"]:>9.2f} {row["p99_ms"]:>9.2f} '
+            f'{(row["peak_rss_bytes"] or 0) / 2**20:>8.1f} MiB\n')
+
+
+def run_isolated(modes, args):
+    """run each mode in a fresh copy of this script, and return all their rows.
+
+    the operations that are always run in-process are reported once, by whichever copy ran them first.
+    """
+    rows = []
+    seen = set()
+    for mode in modes:
+        output = subprocess.run(
+            [sys.executable, '-m', 'benchmarks.image', '--mode', mode, '--json',
+             '--iterations', str(args.iterations), '--seed', str(args.seed)],
+            stdout=subprocess.PIPE, check=True).stdout
+        for line in output.decode('utf-8').splitlines():
+            row = json.loads(line)
+            key = row['operation'], row['mode'], row['image']
+            if key not in seen:
+                seen.add(key)
+                rows.append(row)
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--iterations', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '--mode', action='append', choices=MODES,
+        help='how to run resize and convert. may be given more than once. default: all modes')
+    parser.add_argument('--json', action='store_true', help='print results as JSON lines instead of a table')
+    args = parser.parse_args()
+
+    # keep the order given, dropping repeats
+    modes = list(dict.fromkeys(args.mode or MODES))
+    if len(modes) > 1:
+        rows = run_isolated(modes, args)
+    else:
+        corpus = make_corpus(args.seed)
+        results = asyncio.get_event_loop().run_until_complete(run_benchmarks(corpus, set(modes), args.iterations))
+        rows = list(map(summarize, results))
+
+    if args.json:
+        for row in rows:
+            sys.stdout.write(json.dumps(row) + '\n')
+    else:
+        print_table(rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+# © lambda#0987 <lambda@lambda.dance>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+"""compare the memory and time spent building the body of an emote upload request.
+
+usage: python -m benchmarks.upload_body [--iterations N] [--size BYTES]
+
+"data URL" is what EmoteClient.create used to do: build a base64 data URL string with image_to_base64_url,
+then let aiohttp serialize a dict containing it to JSON and encode that to bytes.
+"direct" is create_emote_body, which encodes the image once, straight into the final buffer.
+"""
+
+import argparse
+import json
+import random
+import sys
+import time
+import tracemalloc
+
+import utils.image
+from utils.emote_client import create_emote_body
+
+ROLE_IDS = ()
+NAME = 'benchmark'
+
+
+def old_body(image):
+    payload = dict(name=NAME, image=utils.image.image_to_base64_url(image), roles=ROLE_IDS)
+    # what aiohttp's JsonPayload does
+    return json.dumps(payload).encode('utf-8')
+
+
+def new_body(image):
+    return create_emote_body(NAME, image, ROLE_IDS)
+
+
+def measure(func, image, iterations):
+    """return (seconds per call, peak bytes allocated during one call)."""
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func(image)
+    elapsed = (time.perf_counter() - start) / iterations
+
+    tracemalloc.start()
+    baseline, _ = tracemalloc.get_traced_memory()
+    body = func(image)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    del body
+    return elapsed, peak - baseline
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--size', type=int, default=256 * 2**10, help='size of the image in bytes')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    n = args.size - 8
+    # a PNG signature is all that mime_type_for_image looks at
+    image = b'\x89PNG\r\n\x1a\n' + rng.getrandbits(8 * n).to_bytes(n, 'little')
+
+    assert json.loads(old_body(image)) == json.loads(new_body(image))
+
+    # the body itself is about 1.33 × the image, so anything above that is spent on intermediate copies
+    sys.stdout.write(f'{"method":<10} {"µs/call":>10} {"peak alloc":>14} {"× image":>8}\n')
+    for label, func in (('data URL', old_body), ('direct', new_body)):
+        elapsed, peak = measure(func, image, args.iterations)
+        sys.stdout.write(f'{label:<10} {elapsed * 1e6:>10.1f} {peak:>14} {peak / len(image):>8.2f}\n')
+
+
+if __name__ == '__main__':
+    main()
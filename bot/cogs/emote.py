@@ -5,12 +5,13 @@ import asyncio
 import cgi
 import collections
 import contextlib
+import functools
 import io
-import json
 import logging
-import operator
+import os
 import posixpath
 import re
+import tempfile
 import zipfile
 import warnings
 import weakref
@@ -22,13 +23,32 @@ from discord.ext import commands
 
 import utils
 import utils.image
-from utils import errors
+from utils import errors, metrics, tracing
+from utils.cache import ByteCache
 from utils.paginator import ListPaginator
+from utils.scheduler import DownloadScheduler
 from utils.emote_client import EmoteClient
 from utils.converter import emote_type_filter_default
+from utils.ec_index import ECIndex
+from utils.emote_index import EmoteHashIndex, GuildEmoteIndex, content_hash
 
 logger = logging.getLogger(__name__)
 
+FETCHES = metrics.counter('emote_manager_fetches_total', 'Files fetched, by source (cache or download)', ('source',))
+FETCH_SECONDS = metrics.histogram(
+    'emote_manager_fetch_seconds', 'Time taken to download files, including waiting for a download slot')
+FETCH_BYTES = metrics.counter('emote_manager_fetch_bytes_total', 'Bytes downloaded')
+EXPORT_PARTS = metrics.counter('emote_manager_export_parts_total', 'Zip files sent by the export command')
+EXPORT_PART_BYTES = metrics.histogram(
+    'emote_manager_export_part_bytes', 'Size of the zip files sent by the export command', buckets=metrics.SIZE_BUCKETS)
+IMPORT_ARCHIVE_BYTES = metrics.histogram(
+    'emote_manager_import_archive_bytes', 'Size of the archives given to the import command',
+    buckets=metrics.SIZE_BUCKETS)
+IMPORT_DUPLICATES = metrics.counter(
+    'emote_manager_import_duplicates_total',
+    'Images skipped by the import command because they were already in the archive or the server, by where',
+    ('source',))
+
 # guilds can have duplicate emotes, so let us create zips to match
 warnings.filterwarnings('ignore', module='zipfile', category=UserWarning, message=r"^Duplicate name: .*$")
 
@@ -37,13 +57,51 @@ class UserCancelledError(commands.UserInputError):
     pass
 
 
+# an image that is ready to be uploaded as an emote
+PreparedImage = collections.namedtuple('PreparedImage', 'data animated converted')
+
+
+class ZipPart:
+    """One zip file of an export, written to in an executor so that the event loop is not blocked."""
+
+    def __init__(self):
+        self.out = io.BytesIO()
+        self.zip = zipfile.ZipFile(self.out, 'w', compression=zipfile.ZIP_STORED)
+        self.entries = 0
+
+    @property
+    def size(self):
+        return self.out.tell()
+
+    async def write(self, name, created_at, data):
+        zinfo = zipfile.ZipInfo(name, date_time=created_at.timetuple()[:6])
+        await asyncio.get_event_loop().run_in_executor(None, self.zip.writestr, zinfo, data)
+        self.entries += 1
+
+    async def finish(self, filename):
+        await asyncio.get_event_loop().run_in_executor(None, self.zip.close)
+        EXPORT_PARTS.inc()
+        EXPORT_PART_BYTES.observe(self.size)
+        self.out.seek(0)
+        return discord.File(self.out, filename)
+
+
 class Emotes(commands.Cog):
     IMAGE_MIMETYPES = {'image/png', 'image/jpeg', 'image/gif', 'image/webp'}
-    # TAR_MIMETYPES = {'application/x-tar', 'application/x-xz', 'application/gzip', 'application/x-bzip2'}
-    TAR_MIMETYPES = {'application/x-tar'}
+    TAR_MIMETYPES = {'application/x-tar', 'application/x-xz', 'application/gzip', 'application/x-bzip2'}
     ZIP_MIMETYPES = {'application/zip', 'application/octet-stream', 'application/x-zip-compressed', 'multipart/x-zip'}
     ARCHIVE_MIMETYPES = TAR_MIMETYPES | ZIP_MIMETYPES
     ZIP_OVERHEAD_BYTES = 30
+    # how many emotes export downloads at once
+    EXPORT_DOWNLOAD_WINDOW = 8
+    # how many images add-these and add-from-ec download at once, ahead of the uploads
+    ADD_DOWNLOAD_WINDOW = 4
+    # the largest archive we're willing to download for the import command
+    MAX_ARCHIVE_SIZE = 100_000_000
+    # how many emotes bulk remove deletes at once. the rate limiter decides how fast they actually go
+    BULK_DELETE_CONCURRENCY = 8
+    # how often, in seconds, to send buffered output and update progress messages
+    PROGRESS_EDIT_INTERVAL = 2.0
 
     def __init__(self, bot):
         self.bot = bot
@@ -65,9 +123,40 @@ class Emotes(commands.Cog):
             })
 
         self.emote_client = EmoteClient(self.bot)
-
-        with open('data/ec-emotes-final.json') as f:
-            self.ec_emotes = json.load(f)
+        self.downloads = DownloadScheduler(
+            max_in_flight=self.bot.config.download_max_in_flight,
+            max_per_host=self.bot.config.download_max_per_host,
+            max_per_guild=self.bot.config.download_max_per_guild)
+        metrics.gauge(
+            'emote_manager_download_queue_depth', 'Downloads waiting for a slot',
+            function=lambda: self.downloads.queue_depth)
+
+        self.image_workers = utils.image.configure_worker_pool(
+            size=self.bot.config.image_worker_count,
+            max_jobs=self.bot.config.image_worker_max_jobs,
+            timeout=self.bot.config.image_processing_timeout)
+        self.bot.loop.create_task(self.image_workers.start())
+        metrics.gauge(
+            'emote_manager_image_queue_depth', 'Image jobs waiting for a worker',
+            function=lambda: self.image_workers.queue_depth)
+        self.image_cache = utils.image.configure_image_cache(
+            memory_limit=self.bot.config.image_cache_memory_limit,
+            disk_path=self.bot.config.image_cache_path,
+            disk_limit=self.bot.config.image_cache_disk_limit)
+        # keyed by utils.emote.cdn_cache_key(), which explains why entries never go stale
+        self.cdn_cache = ByteCache(
+            memory_limit=self.bot.config.cdn_cache_memory_limit,
+            disk_path=self.bot.config.cdn_cache_path,
+            disk_limit=self.bot.config.cdn_cache_disk_limit)
+
+        # looked up on disk, and only opened when add-from-ec is first used.
+        # the Docker image ships it prebuilt; anywhere else, build it now, off the event loop
+        self.ec_emotes = ECIndex()
+        self.bot.loop.create_task(self.ec_emotes.build_if_stale())
+        # for parse_emote, disambiguate, list and slot counts, kept current by on_guild_emojis_update
+        self.emote_index = GuildEmoteIndex()
+        # used to skip importing images the server already has, if dedupe_imports_against_guild is set
+        self.emote_hashes = EmoteHashIndex()
 
         # keep track of paginators so we can end them when the cog is unloaded
         self.paginators = weakref.WeakSet()
@@ -76,6 +165,8 @@ class Emotes(commands.Cog):
         async def close():
             await self.http.close()
             await self.emote_client.close()
+            await self.image_workers.close()
+            self.ec_emotes.close()
 
             for paginator in self.paginators:
                 await paginator.stop()
@@ -114,6 +205,14 @@ class Emotes(commands.Cog):
             await context.send(
                 f'{self.bot.config.FAILURE_EMOJI} Sorry, this command may only be used in a server.')
 
+    @commands.Cog.listener()
+    async def on_guild_emojis_update(self, guild, before, after):
+        self.emote_index.update(guild, after)
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild):
+        self.emote_index.discard(guild.id)
+
     @commands.command(usage='[name] <image URL or custom emote>')
     async def add(self, context, *args):
         """Add a new emote to this server.
@@ -137,20 +236,17 @@ class Emotes(commands.Cog):
     async def add_these(self, context, *emotes):
         """Add a bunch of custom emotes."""
 
-        ran = False
         # we could use *emotes: discord.PartialEmoji here but that would require spaces between each emote.
         # and would fail if any arguments were not valid emotes
+        sources = []
         for match in re.finditer(utils.emote.RE_CUSTOM_EMOTE, ''.join(emotes)):
-            ran = True
             animated, name, id = match.groups()
-            image_url = utils.emote.url(id, animated=animated)
-            async with context.typing():
-                message = await self.add_safe(context, name, image_url)
-                await context.send(message)
+            sources.append((name, utils.emote.url(id, animated=animated), None))
 
-        if not ran:
+        if not sources:
             return await context.send('Error: no custom emotes were provided.')
 
+        await self.add_from_urls(context, sources)
         await context.message.add_reaction(self.bot.config.SUCCESS_EMOJI)
 
     @classmethod
@@ -203,26 +299,50 @@ class Emotes(commands.Cog):
     @commands.command(name='add-from-ec', aliases=['addfromec'])
     async def add_from_ec(self, context, name, *names):
         """Copies one or more emotes from Emote Collector to your server."""
+        # look them all up first, so that the downloads can start together
+        sources = [self.resolve_ec_emote(context, name) for name in (name,) + names]
+        if len(sources) == 1 and type(sources[0]) is str:  # error case
+            return await context.send(sources[0])
+
+        await self.add_from_urls(context, sources)
         if names:
-            for name in (name,) + names:
-                await context.invoke(self.add_from_ec, name)
             await context.message.add_reaction(self.bot.config.SUCCESS_EMOJI)
-            return
 
+    def resolve_ec_emote(self, context, name):
+        """Return the (name, image URL, audit log reason) for an Emote Collector emote.
+
+        If it's not found, return a string that should be sent to the user.
+        """
+        name = name.strip(':')
         try:
-            emote = self.ec_emotes[name.strip(':').lower()]
+            emote = self.ec_emotes[name]
         except KeyError:
-            return await context.send("Emote not found in Emote Collector's database.")
+            message = f"`{name}` was not found in Emote Collector's database."
+            suggestions = self.ec_emotes.search(name, limit=5)
+            if suggestions:
+                message += ' Did you mean: ' + ', '.join(fr'\:{emote["name"]}:' for emote in suggestions) + '?'
+            return discord.utils.escape_mentions(message)
 
         reason = (
             f'Added from Emote Collector by {utils.format_user(context.author)}. '
             f'Original emote author ID: {emote["author"]}')
+        return name, utils.emote.url(emote['id'], animated=emote['animated']), reason
 
-        image_url = utils.emote.url(emote['id'], animated=emote['animated'])
-        async with context.typing():
-            message = await self.add_safe(context, name, image_url, reason=reason)
+    @public
+    @commands.command(name='search-ec', aliases=['searchec', 'ec-search'])
+    async def search_ec(self, context, query):
+        """Search Emote Collector's database for emotes with names like the one given.
 
-        await context.send(message)
+        Names starting with your query are listed first, followed by close matches.
+        Add them with the add-from-ec command.
+        """
+        results = self.ec_emotes.search(query)
+        if not results:
+            return await context.send("No emotes like that were found in Emote Collector's database.")
+
+        await context.send('\n'.join(
+            fr'\:{emote["name"]}: <{utils.emote.url(emote["id"], animated=emote["animated"])}>'
+            for emote in results))
 
     @public
     @emote_type_filter_default
@@ -241,14 +361,20 @@ class Emotes(commands.Cog):
         if not emotes:
             raise commands.BadArgument('No emotes of that type were found in this server.')
 
-        async with context.typing():
-            async for zip_file in self.archive_emotes(context, emotes):
+        async with context.typing(), utils.output.OutputSink(context, interval=self.PROGRESS_EDIT_INTERVAL) as output:
+            async for zip_file in self.archive_emotes(context, emotes, output):
                 await context.send(file=zip_file)
 
-    async def archive_emotes(self, context, emotes):
+    async def archive_emotes(self, context, emotes, output):
+        """Download emotes and yield zip files of them, each under the server's file size limit.
+
+        Emotes that could not be added are reported to output, a utils.output.OutputSink.
+
+        Downloads are written to the current zip as they finish, and each zip is yielded as soon as it is full,
+        so only about one zip plus EXPORT_DOWNLOAD_WINDOW emotes are held in memory, however many emotes there are.
+        """
         filesize_limit = context.guild.filesize_limit
         discrims = collections.defaultdict(int)
-        downloaded = collections.deque()
 
         async def download(emote):
             # don't put two files in the zip with the same name
@@ -262,58 +388,42 @@ class Emotes(commands.Cog):
             name = f'{name}.{"gif" if emote.animated else "png"}'
 
             # place some level of trust on discord's CDN to actually give us images
-            data = await self.fetch_safe(str(emote.url), validate_headers=False)
+            data = await self.fetch_safe(str(emote.url), validate_headers=False, guild_id=context.guild.id)
             if type(data) is str:  # error case
-                await context.send(f'{emote}: {data}')
+                output.add(f'{emote}: {data}')
                 return
 
             est_zip_overhead = len(name) + self.ZIP_OVERHEAD_BYTES
             est_size_in_zip = est_zip_overhead + len(data)
             if est_size_in_zip >= filesize_limit:
-                self.bot.loop.create_task(
-                    context.send(f'{emote} could not be added because it alone would exceed the file size limit.')
-                )
+                output.add(f'{emote} could not be added because it alone would exceed the file size limit.')
                 return
 
-            downloaded.append((name, emote.created_at, est_size_in_zip, data))
-
-        await utils.gather_or_cancel(*map(download, emotes))
+            return name, emote.created_at, est_size_in_zip, data
 
         count = 1
-        while True:
-            out = io.BytesIO()
-            with zipfile.ZipFile(out, 'w', compression=zipfile.ZIP_STORED) as zip:
-                while True:
-                    try:
-                        item = downloaded.popleft()
-                    except IndexError:
-                        break
-
-                    name, created_at, est_size, image_data = item
-
-                    if out.tell() + est_size >= filesize_limit:
-                        # adding this emote would bring us over the file size limit
-                        downloaded.appendleft(item)
-                        break
-
-                    zinfo = zipfile.ZipInfo(name, date_time=created_at.timetuple()[:6])
-                    zip.writestr(zinfo, image_data)
+        part = ZipPart()
+        async for name, created_at, est_size, image_data in utils.pipeline.run(
+            emotes, (download, self.EXPORT_DOWNLOAD_WINDOW),
+        ):
+            if part.entries and part.size + est_size >= filesize_limit:
+                # adding this emote would bring us over the file size limit
+                yield await part.finish(f'emotes-{context.guild.id}-{count}.zip')
+                count += 1
+                part = ZipPart()
 
-                if out.tell() == 0:
-                    # no emotes were written
-                    break
+            await part.write(name, created_at, image_data)
 
-            out.seek(0)
-            yield discord.File(out, f'emotes-{context.guild.id}-{count}.zip')
-            count += 1
+        if part.entries:
+            yield await part.finish(f'emotes-{context.guild.id}-{count}.zip')
 
     @commands.command(name='import', aliases=['add-zip', 'add-tar', 'add-from-zip', 'add-from-tar'])
     async def import_(self, context, url=None):
-        """Add several emotes from a .zip or .tar archive.
+        """Add several emotes from a .zip or .tar archive. The .tar may be compressed (.tar.gz, .tar.bz2, .tar.xz).
 
         You may either pass a URL to an archive or upload one as an attachment.
         All valid GIF, PNG, and JPEG files in the archive will be uploaded as emotes.
-        The rest will be ignored.
+        The rest will be ignored, as will images that appear more than once.
         """
         if url and context.message.attachments:
             raise commands.BadArgument('Either a URL or an attachment must be given, not both.')
@@ -324,44 +434,183 @@ class Emotes(commands.Cog):
 
         url = url or context.message.attachments[0].url
         async with context.typing():
-            archive = await self.fetch_safe(url, valid_mimetypes=self.ARCHIVE_MIMETYPES)
+            try:
+                archive = await self.fetch_safe(
+                    url,
+                    valid_mimetypes=self.ARCHIVE_MIMETYPES,
+                    spool_limit=self.MAX_ARCHIVE_SIZE,
+                    guild_id=context.guild.id)
+            except errors.FileTooBigError as exc:
+                await context.send(f'Error: that archive is too big. The limit is {humanize.naturalsize(exc.limit)}.')
+                return
         if type(archive) is str:  # error case
             await context.send(archive)
             return
 
-        await self.add_from_archive(context, archive)
+        with archive:
+            IMPORT_ARCHIVE_BYTES.observe(os.fstat(archive.fileno()).st_size)
+            await self.add_from_archive(context, archive)
         with contextlib.suppress(discord.HTTPException):
             # so they know when we're done
             await context.message.add_reaction(self.bot.config.SUCCESS_EMOJI)
 
     async def add_from_archive(self, context, archive):
+        """Add every image in an archive, sending one message per member.
+
+        Members flow through a pipeline of extract → sniff → transform → upload, so that images further along
+        in the archive are converted and resized while earlier ones wait on the upload rate limit.
+        Images that are in the archive more than once are only added once, and if dedupe_imports_against_guild
+        is configured, images the server already has are skipped.
+        """
         limit = 50_000_000  # prevent someone from trying to make a giant compressed file
-        async for name, img, error in utils.archive.extract_async(io.BytesIO(archive), size_limit=limit):
+        # content hash → name of the first member with that image
+        seen = {}
+        # content hash → emote in this server with that image
+        existing = {}
+
+        async def sniff(member):
+            name, img, error = member
+            if error is not None:
+                return self.format_extraction_error(name, error)
+            # the extractor only judged it by its header, so make sure the rest of it is there too
             try:
                 utils.image.mime_type_for_image(img)
             except errors.InvalidImageError:
-                continue
-            if error is None:
-                name = self.format_emote_filename(posixpath.basename(name))
-                async with context.typing():
-                    message = await self.add_safe_bytes(context, name, img)
-                await context.send(message)
-                continue
-
-            if isinstance(error, errors.FileTooBigError):
-                await context.send(
-                    f'{name}: file too big. '
-                    f'The limit is {humanize.naturalsize(error.limit)} '
-                    f'but this file is {humanize.naturalsize(error.size)}.')
-                continue
-
-            await context.send(f'{name}: {error}')
+                return None
+
+            # skip duplicates before they cost an image job and an upload
+            digest = content_hash(img)
+            if digest in seen:
+                IMPORT_DUPLICATES.labels('archive').inc()
+                return f'{name}: skipped, because it is the same image as {seen[digest]}.'
+            seen[digest] = name
+            emote = existing.get(digest)
+            if emote is not None:
+                IMPORT_DUPLICATES.labels('guild').inc()
+                return f'{name}: skipped, because this server already has it as {emote}.'
+
+            return self.format_emote_filename(posixpath.basename(name)), img, None
+
+        members = utils.archive.extract_async(archive, size_limit=limit, images_only=True)
+        async with context.typing(), utils.output.OutputSink(
+            context, progress='Importing emotes…', interval=self.PROGRESS_EDIT_INTERVAL,
+        ) as output:
+            if self.bot.config.dedupe_imports_against_guild:
+                existing = await self.guild_image_hashes(context.guild)
+            processed = 0
+            async for message in self.add_pipeline(context, members, (sniff, 1)):
+                output.add(message)
+                processed += 1
+                output.progress = f'Importing emotes… {processed} processed so far.'
+            output.progress = f'Import finished. {processed} files processed.'
+
+    async def guild_image_hashes(self, guild):
+        """Return a dict of content_hash() → emote for the emotes in guild.
+
+        Emotes we haven't hashed before are downloaded from the CDN, which doesn't count against the API rate limits.
+        Those that can't be downloaded are left out.
+        """
+        async def hash_emote(emote):
+            digest = self.emote_hashes.get(emote.id)
+            if digest is None:
+                try:
+                    data = await self.fetch_safe(str(emote.url), validate_headers=False, guild_id=guild.id)
+                except errors.EmoteManagerError:
+                    return None
+                if type(data) is str:  # error case
+                    return None
+                digest = content_hash(data)
+                self.emote_hashes.put(emote.id, digest)
+            return digest, emote
+
+        with tracing.span('guild hashes'):
+            hashes = await asyncio.gather(*map(hash_emote, guild.emojis))
+        return dict(pair for pair in hashes if pair is not None)
+
+    async def add_from_urls(self, context, sources):
+        """Add an emote for each (name, image URL, audit log reason) in sources, reporting the result of each.
+
+        Strings in sources are sent to the user as is. Images are downloaded ADD_DOWNLOAD_WINDOW at a time,
+        while earlier ones are prepared and uploaded, so that the downloads overlap the upload rate limit.
+        """
+        self.emote_client.check_rl(context.guild.id)
+
+        async def download(source):
+            if type(source) is str:  # error case
+                return source
+            name, url, reason = source
+            try:
+                image_data = await self.fetch_safe(url, guild_id=context.guild.id)
+            except errors.InvalidFileError:
+                return f'{name}: {errors.InvalidImageError()}'
+            except errors.EmoteManagerError as exc:
+                return f'{name}: {exc}'
+            if type(image_data) is str:  # error case
+                return f'{name}: {image_data}'
+            return name, image_data, reason
+
+        total = len(sources)
+        async with context.typing(), utils.output.OutputSink(
+            context,
+            progress=f'Adding {total} emotes…' if total > 1 else None,
+            interval=self.PROGRESS_EDIT_INTERVAL,
+        ) as output:
+            done = 0
+            async for message in self.add_pipeline(context, sources, (download, self.ADD_DOWNLOAD_WINDOW)):
+                output.add(message)
+                done += 1
+                if total > 1:
+                    output.progress = f'Adding emotes… {done} of {total} done.'
+
+    def add_pipeline(self, context, source, *stages):
+        """Run source through stages, then prepare and upload the results as emotes, yielding a message for each.
+
+        The last of stages must return (name, image data, audit log reason) tuples,
+        or strings, which are passed through to be sent to the user.
+        Images are prepared image_worker_count at a time while earlier ones wait on the upload rate limit.
+        """
+        counts = self.slot_counts(context.guild)
+
+        async def transform(item):
+            if type(item) is str:  # error case
+                return item
+            name, img, reason = item
+            try:
+                prepared = await self.prepare_emote_bytes(context, img, counts)
+            except (errors.InvalidImageError, errors.ImageProcessingTimeoutError) as exc:
+                return f'{name}: {exc}'
+            if type(prepared) is str:  # error case
+                return prepared
+            return name, prepared, reason
+
+        async def upload(item):
+            if type(item) is str:  # error case
+                return item
+            name, prepared, reason = item
+            return await self.upload_prepared_emote(context, name, prepared, counts, reason=reason)
+
+        return utils.pipeline.run(
+            source,
+            *stages,
+            (transform, self.bot.config.image_worker_count),
+            (upload, 1),
+        )
+
+    @staticmethod
+    def format_extraction_error(name, error):
+        if isinstance(error, errors.FileTooBigError):
+            return (
+                f'{name}: file too big. '
+                f'The limit is {humanize.naturalsize(error.limit)} '
+                f'but this file is {humanize.naturalsize(error.size)}.')
+
+        return f'{name}: {error}'
 
     async def add_safe(self, context, name, url, *, reason=None):
         """Try to add an emote. Returns a string that should be sent to the user."""
         self.emote_client.check_rl(context.guild.id)
         try:
-            image_data = await self.fetch_safe(url)
+            image_data = await self.fetch_safe(url, guild_id=context.guild.id)
         except errors.InvalidFileError:
             raise errors.InvalidImageError
 
@@ -369,10 +618,18 @@ class Emotes(commands.Cog):
             return image_data
         return await self.add_safe_bytes(context, name, image_data, reason=reason)
 
-    async def fetch_safe(self, url, valid_mimetypes=None, *, validate_headers=False):
+    @tracing.traced('fetch')
+    async def fetch_safe(
+        self, url, valid_mimetypes=None, *, validate_headers=False, spool_limit=None, guild_id=None,
+    ):
         """Try to fetch a URL. On error return a string that should be sent to the user."""
         try:
-            return await self.fetch(url, valid_mimetypes=valid_mimetypes, validate_headers=validate_headers)
+            return await self.fetch(
+                url,
+                valid_mimetypes=valid_mimetypes,
+                validate_headers=validate_headers,
+                spool_limit=spool_limit,
+                guild_id=guild_id)
         except asyncio.TimeoutError:
             return 'Error: retrieving the image took too long.'
         except ValueError:
@@ -385,34 +642,84 @@ class Emotes(commands.Cog):
 
         If the image is static and there are not enough free static slots, convert the image to a gif instead.
         """
-        counts = collections.Counter(map(operator.attrgetter('animated'), context.guild.emojis))
+        counts = self.slot_counts(context.guild)
+        prepared = await self.prepare_emote_bytes(context, image_data, counts)
+        if type(prepared) is str:  # error case
+            return prepared
+        return await self.upload_prepared_emote(context, name, prepared, counts, reason=reason)
+
+    def slot_counts(self, guild):
+        """Return a Counter of how many static (False) and animated (True) emote slots are used in guild."""
+        return self.emote_index.slot_counts(guild)
+
+    async def prepare_emote_bytes(self, context, image_data: bytes, counts):
+        """Convert and resize an image as necessary for it to be uploaded as an emote.
+
+        counts is the result of slot_counts(). The slot this image will use is reserved in it,
+        so that several images can be prepared at once.
+        Returns a PreparedImage, or on error, a string that should be sent to the user.
+        """
         # >= rather than == because there are sneaky ways to exceed the limit
         if counts[False] >= context.guild.emoji_limit and counts[True] >= context.guild.emoji_limit:
-            # we raise instead of returning a string in order to abort commands that run this function in a loop
             return 'This server is out of emote slots. Check `em/stats` to view your servers limits'
 
         static = utils.image.mime_type_for_image(image_data) != 'image/gif'
         converted = False
         if static and counts[False] >= context.guild.emoji_limit:
             image_data = await utils.image.convert_to_gif_in_subprocess(image_data)
+            static = False
             converted = True
 
+        counts[not static] += 1
+        if len(image_data) > 256 * 1024:
+            try:
+                image_data = await utils.image.resize_in_subprocess(image_data)
+            except BaseException:
+                counts[not static] -= 1
+                raise
+
+        return PreparedImage(data=image_data, animated=not static, converted=converted)
+
+    async def upload_prepared_emote(self, context, name, prepared, counts, *, reason=None):
+        """Upload an image returned by prepare_emote_bytes(). Returns a string that should be sent to the user."""
         try:
-            emote = await self.create_emote_from_bytes(context, name, image_data, reason=reason)
+            emote = await self.create_emote_from_bytes(context, name, prepared.data, reason=reason)
         except discord.InvalidArgument:
+            counts[prepared.animated] -= 1
             return discord.utils.escape_mentions(
                 f'{name}: The file supplied was not a valid GIF, PNG, JPEG, or WEBP file.'
             )
         except discord.HTTPException as ex:
+            counts[prepared.animated] -= 1
             return discord.utils.escape_mentions(
                 f'{name}: An error occurred while creating the the emote:\n'
                 + utils.format_http_exception(ex))
+        self.emote_index.created(context.guild, int(emote.id), prepared.animated)
         s = f'Emote {emote} successfully created'
-        return s + ' as a GIF.' if converted else s + '.'
+        return s + ' as a GIF.' if prepared.converted else s + '.'
+
+    async def fetch(
+        self, url, valid_mimetypes=IMAGE_MIMETYPES, *, validate_headers=True, spool_limit=None, guild_id=None,
+    ):
+        """Fetch a URL, returning its body.
+
+        Downloads wait their turn in self.downloads, where guild_id is the server they are on behalf of.
 
-    async def fetch(self, url, valid_mimetypes=IMAGE_MIMETYPES, *, validate_headers=True):
+        If spool_limit is given, the body is written to a temporary file, which is returned instead,
+        and errors.FileTooBigError is raised if the body is larger than spool_limit bytes.
+        Otherwise, emote images from Discord's CDN are served from self.cdn_cache when possible.
+        """
         valid_mimetypes = valid_mimetypes or self.IMAGE_MIMETYPES
 
+        cdn_key = utils.emote.cdn_cache_key(url) if spool_limit is None else None
+        if cdn_key is not None:
+            data = await self.cdn_cache.get(cdn_key)
+            if data is not None:
+                FETCHES.labels('cache').inc()
+                tracing.annotate(cached=True)
+                return data
+        FETCHES.labels('download').inc()
+
         def validate_headers(response):
             response.raise_for_status()
             # some dumb servers also send '; charset=UTF-8' which we should ignore
@@ -420,23 +727,57 @@ class Emotes(commands.Cog):
             if mimetype not in valid_mimetypes:
                 raise errors.InvalidFileError
 
-        async def validate(request):
+        async def validate(request, read=aiohttp.ClientResponse.read):
             try:
                 async with request as response:
                     validate_headers(response)
-                    return await response.read()
+                    return await read(response)
             except aiohttp.ClientResponseError:
                 raise
             except aiohttp.ClientError as exc:
                 raise errors.EmoteManagerError(f'An error occurred while retrieving the file: {exc}')
 
-        if validate_headers:
-            await validate(self.http.head(url, timeout=self.bot.config.http_head_timeout))
-        return await validate(self.http.get(url))
+        with FETCH_SECONDS.time():
+            async with self.downloads.slot(url, guild_id):
+                if validate_headers:
+                    with tracing.span('head'):
+                        await validate(self.http.head(url, timeout=self.bot.config.http_head_timeout))
+                with tracing.span('get'):
+                    if spool_limit is not None:
+                        return await validate(
+                            self.http.get(url), functools.partial(self.spool, size_limit=spool_limit))
+
+                    data = await validate(self.http.get(url))
+        FETCH_BYTES.inc(len(data))
+
+        if cdn_key is not None:
+            await self.cdn_cache.put(cdn_key, data)
+        return data
+
+    @staticmethod
+    async def spool(response, *, size_limit):
+        """Write the body of an HTTP response to a temporary file, which is returned rewound."""
+        if response.content_length is not None and response.content_length > size_limit:
+            raise errors.FileTooBigError(response.content_length, size_limit)
+
+        fp = tempfile.TemporaryFile()
+        size = 0
+        try:
+            async for chunk in response.content.iter_chunked(64 * 1024):
+                size += len(chunk)
+                if size > size_limit:
+                    raise errors.FileTooBigError(size, size_limit)
+                fp.write(chunk)
+            fp.seek(0)
+        except BaseException:
+            fp.close()
+            raise
+        finally:
+            FETCH_BYTES.inc(size)
+
+        return fp
 
     async def create_emote_from_bytes(self, context, name, image_data: bytes, *, reason=None):
-        if len(image_data) > 256 * 1024:
-            image_data = await utils.image.resize_in_subprocess(image_data)
         if reason is None:
             reason = 'Created by ' + utils.format_user(context.author)
         return await self.emote_client.create(guild=context.guild, name=name, image=image_data, reason=reason)
@@ -450,13 +791,78 @@ class Emotes(commands.Cog):
         if not emotes:
             emote = await self.parse_emote(context, emote)
             await emote.delete(reason='Removed by ' + utils.format_user(context.author))
+            self.emote_index.deleted(context.guild, emote.id)
             await context.send(fr'Emote \:{emote.name}: successfully removed.')
         else:
-            for emote in (emote,) + emotes:
-                await context.invoke(self.remove, emote)
+            await self.remove_many(context, (emote,) + emotes)
             with contextlib.suppress(discord.HTTPException):
                 await context.message.add_reaction(self.bot.config.SUCCESS_EMOJI)
 
+    async def remove_many(self, context, names):
+        """Remove several emotes at once, reporting progress in a single message that is edited as we go.
+
+        All the names are resolved before anything is deleted. The deletes then run concurrently,
+        as fast as the rate limit allows, and a summary is sent at the end.
+        Once one is rate limited, the deletes that haven't started are skipped, and listed once at the end.
+        """
+        failures = []
+        emotes = {}
+        for name in names:
+            try:
+                emote = await self.parse_emote(context, name)
+            except errors.EmoteNotFoundError as exc:
+                failures.append(discord.utils.escape_mentions(str(exc)))
+            else:
+                emotes[emote.id] = emote
+
+        reason = 'Removed by ' + utils.format_user(context.author)
+        rate_limited = None
+
+        async def delete(emote):
+            """return True if emote was removed, an error message, or emote itself if it was skipped"""
+            nonlocal rate_limited
+            if rate_limited is not None:
+                return emote
+            try:
+                await self.emote_client.delete(guild=context.guild, emote_id=emote.id, reason=reason)
+            except errors.RateLimitedError as exc:
+                rate_limited = exc
+                return emote
+            except discord.HTTPException as exc:
+                return discord.utils.escape_mentions(
+                    fr'\:{emote.name}: An error occurred while removing the emote:'
+                    + '\n' + utils.format_http_exception(exc))
+            self.emote_index.deleted(context.guild, emote.id)
+            return True
+
+        async with utils.output.OutputSink(
+            context,
+            progress=f'Removing {len(emotes)} emotes…' if emotes else None,
+            interval=self.PROGRESS_EDIT_INTERVAL,
+        ) as output:
+            for failure in failures:
+                output.add(failure)
+
+            removed = done = 0
+            skipped = []
+            async for result in utils.pipeline.run(emotes.values(), (delete, self.BULK_DELETE_CONCURRENCY)):
+                done += 1
+                if result is True:
+                    removed += 1
+                elif type(result) is str:  # error case
+                    output.add(result)
+                else:
+                    skipped.append(result)
+                output.progress = f'Removing emotes… {done} of {len(emotes)} done.'
+
+            if skipped:
+                output.add(discord.utils.escape_mentions(
+                    f'{rate_limited}\nThese emotes were not removed: '
+                    + ' '.join(fr'\:{emote.name}:' for emote in skipped)))
+
+            if emotes:
+                output.progress = f'{removed} of {len(emotes)} emotes successfully removed.'
+
     @commands.command(aliases=('mv',))
     async def rename(self, context, old, new_name):
         """Rename an emote on this server.
@@ -488,33 +894,26 @@ class Emotes(commands.Cog):
         If "static" is provided, only show static emotes.
         If “all” is provided, show all emotes.
         """
-        emotes = sorted(
-            filter(image_type, context.guild.emojis),
-            key=lambda e: e.name.lower())
-
-        processed = []
-        for emote in emotes:
-            raw = str(emote).replace(':', r'\:')
-            processed.append(f'{emote} {raw}')
-
-        paginator = ListPaginator(context, processed)
+        emotes = self.emote_index.listing(context.guild, image_type)
+        paginator = ListPaginator(context, emotes, format_item=self.format_list_entry)
         self.paginators.add(paginator)
         await paginator.begin()
 
+    @staticmethod
+    def format_list_entry(emote):
+        raw = str(emote).replace(':', r'\:')
+        return f'{emote} {raw}'
+
     @public
     @commands.command(aliases=['status'])
     async def stats(self, context):
         """The current number of animated and static emotes relative to the limits."""
         emote_limit = context.guild.emoji_limit
 
-        static_emotes = animated_emotes = total_emotes = 0
-        for emote in context.guild.emojis:
-            if emote.animated:
-                animated_emotes += 1
-            else:
-                static_emotes += 1
-
-            total_emotes += 1
+        counts = self.slot_counts(context.guild)
+        static_emotes = counts[False]
+        animated_emotes = counts[True]
+        total_emotes = static_emotes + animated_emotes
 
         percent_static = round((static_emotes / emote_limit) * 100, 2)
         percent_animated = round((animated_emotes / emote_limit) * 100, 2)
@@ -545,7 +944,7 @@ class Emotes(commands.Cog):
         if match:
             id = int(match['id'])
             if local:
-                emote = discord.utils.get(context.guild.emojis, id=id)
+                emote = self.emote_index.get(context.guild, id)
                 if emote:
                     return emote
             else:
@@ -559,7 +958,7 @@ class Emotes(commands.Cog):
 
     async def disambiguate(self, context, name):
         name = name.strip(':')  # in case the user tries :foo: and foo is animated
-        candidates = [e for e in context.guild.emojis if e.name.lower() == name.lower() and e.require_colons]
+        candidates = [e for e in self.emote_index.named(context.guild, name) if e.require_colons]
         if not candidates:
             raise errors.EmoteNotFoundError(name)
 
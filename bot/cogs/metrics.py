@@ -0,0 +1,65 @@
+# © lambda#0987 <lambda@lambda.dance>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import logging
+import time
+import weakref
+
+from discord.ext import commands
+
+from utils import metrics
+
+logger = logging.getLogger(__name__)
+
+COMMAND_SECONDS = metrics.histogram(
+    'emote_manager_command_seconds', 'Time taken by each command invocation, by command and outcome',
+    ('command', 'outcome'))
+
+
+class Metrics(commands.Cog):
+    """Times commands, and serves utils.metrics over HTTP if metrics_port is configured."""
+
+    def __init__(self, bot):
+        self.bot = bot
+        # context → time.perf_counter() when the command started
+        self.started_at = weakref.WeakKeyDictionary()
+        self.runner = None
+
+        metrics.gauge(
+            'emote_manager_guilds', 'Guilds this process is in', function=lambda: len(self.bot.guilds))
+        metrics.gauge(
+            'emote_manager_latency_seconds', 'Average gateway latency of our shards', function=lambda: self.bot.latency)
+
+        if self.bot.config.metrics_port is not None:
+            self.bot.loop.create_task(self.start_server())
+
+    async def start_server(self):
+        self.runner = await metrics.start_server(self.bot.config.metrics_host, self.bot.config.metrics_port)
+        logger.info(
+            'Serving metrics at http://%s:%s/metrics', self.bot.config.metrics_host, self.bot.config.metrics_port)
+
+    def cog_unload(self):
+        if self.runner is not None:
+            self.bot.loop.create_task(self.runner.cleanup())
+
+    @commands.Cog.listener()
+    async def on_command(self, context):
+        self.started_at[context] = time.perf_counter()
+
+    @commands.Cog.listener()
+    async def on_command_completion(self, context):
+        self.observe(context, 'success')
+
+    @commands.Cog.listener()
+    async def on_command_error(self, context, error):
+        self.observe(context, 'error')
+
+    def observe(self, context, outcome):
+        started_at = self.started_at.pop(context, None)
+        # errors raised before the command started, such as CommandNotFound, aren't timed
+        if started_at is not None:
+            COMMAND_SECONDS.labels(context.command.qualified_name, outcome).observe(time.perf_counter() - started_at)
+
+
+def setup(bot):
+    bot.add_cog(Metrics(bot))
@@ -19,3 +19,20 @@ class Config:
     ec_api_base_url: Optional[str]
     http_head_timeout: int
     http_read_timeout: int
+    download_max_in_flight: int
+    download_max_per_host: int
+    download_max_per_guild: int
+    image_worker_count: int
+    image_worker_max_jobs: int
+    image_processing_timeout: float
+    image_cache_memory_limit: int
+    image_cache_path: Optional[str]
+    image_cache_disk_limit: int
+    cdn_cache_memory_limit: int
+    cdn_cache_path: Optional[str]
+    cdn_cache_disk_limit: int
+    defer_debug_extensions: bool
+    metrics_host: str
+    metrics_port: Optional[int]
+    trace_sample_rate: float
+    dedupe_imports_against_guild: bool
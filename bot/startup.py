@@ -0,0 +1,124 @@
+# © lambda#0987 <lambda@lambda.dance>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+"""measures where the bot's startup time goes: imports, extensions, and the wait for the first shard"""
+
+import contextlib
+import importlib.abc
+import sys
+import time
+
+
+class _TimedLoader:
+    def __init__(self, timer, loader):
+        self._timer = timer
+        self._loader = loader
+
+    def __getattr__(self, name):
+        return getattr(self._loader, name)
+
+    def create_module(self, spec):
+        return self._loader.create_module(spec)
+
+    def exec_module(self, module):
+        timer = self._timer
+        # time spent importing other modules while this one runs
+        timer._stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            self._loader.exec_module(module)
+        finally:
+            elapsed = time.perf_counter() - start
+            children = timer._stack.pop()
+            if timer._stack:
+                timer._stack[-1] += elapsed
+            timer.cumulative[module.__name__] = elapsed
+            timer.own[module.__name__] = elapsed - children
+
+            # don't leave ourselves behind in the module
+            module.__loader__ = self._loader
+            if module.__spec__ is not None:
+                module.__spec__.loader = self._loader
+
+
+class ImportTimer(importlib.abc.MetaPathFinder):
+    """Times each module imported while installed, like python -X importtime, but readable from inside the process.
+
+    Only meant for startup, which is single threaded; imports made concurrently in other threads may be misattributed.
+    """
+
+    def __init__(self):
+        # module name → seconds, including the modules it imported
+        self.cumulative = {}
+        # module name → seconds, excluding the modules it imported
+        self.own = {}
+        self._stack = []
+
+    def install(self):
+        sys.meta_path.insert(0, self)
+        return self
+
+    def uninstall(self):
+        with contextlib.suppress(ValueError):
+            sys.meta_path.remove(self)
+
+    def find_spec(self, name, path, target=None):
+        for finder in sys.meta_path:
+            if finder is self:
+                continue
+            find_spec = getattr(finder, 'find_spec', None)
+            if find_spec is None:
+                continue
+            spec = find_spec(name, path, target)
+            if spec is not None:
+                break
+        else:
+            return None
+
+        if spec.loader is not None and hasattr(spec.loader, 'exec_module'):
+            spec.loader = _TimedLoader(self, spec.loader)
+        return spec
+
+    def slowest(self, n=10):
+        """Return the n (module name, cumulative seconds) pairs of the slowest top level imports."""
+        top_level = ((name, t) for name, t in self.cumulative.items() if '.' not in name)
+        return sorted(top_level, key=lambda pair: pair[1], reverse=True)[:n]
+
+
+class StartupReport:
+    """Collects how long startup took, for logging once the first shard is ready.
+
+    started_at is a time.perf_counter() reading from as early in startup as possible.
+    """
+
+    def __init__(self, started_at, *, import_timer=None):
+        self.started_at = started_at
+        self.import_timer = import_timer
+        # extension name → seconds to load it
+        self.extensions = {}
+        # seconds from started_at until the first shard was ready
+        self.first_shard_ready = None
+
+    @contextlib.contextmanager
+    def timed(self, extension):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.extensions[extension] = time.perf_counter() - start
+
+    def shard_ready(self):
+        """Record that a shard is ready. Return whether it was the first."""
+        if self.first_shard_ready is not None:
+            return False
+        self.first_shard_ready = time.perf_counter() - self.started_at
+        return True
+
+    def format(self):
+        lines = [f'first shard ready {self.first_shard_ready:.2f}s after startup']
+        for name, seconds in self.extensions.items():
+            lines.append(f'  extension {name}: {seconds:.3f}s')
+        if self.import_timer is not None:
+            for name, seconds in self.import_timer.slowest():
+                lines.append(f'  import {name}: {seconds:.3f}s')
+        return '\n'.join(lines)
@@ -0,0 +1,55 @@
+# © lambda#0987 <lambda@lambda.dance>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import io
+import tarfile
+import unittest
+import zipfile
+
+from utils import archive, errors
+
+GIF = b'GIF89a\x01\x00\x01\x00' + bytes(32)
+
+
+def make_zip(files):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w') as zip:
+        for name, content in files.items():
+            zip.writestr(name, content)
+    return buf.getvalue()
+
+
+def make_tar(files):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w') as tar:
+        for name, content in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    return buf.getvalue()
+
+
+def extract(data, **kwargs):
+    return [(info.filename, info.content) for info in archive.extract(io.BytesIO(data), **kwargs)]
+
+
+class TestExtract(unittest.TestCase):
+    def test_zip(self):
+        self.assertEqual(extract(make_zip({'a.gif': GIF})), [('a.gif', GIF)])
+
+    def test_tar(self):
+        self.assertEqual(extract(make_tar({'a.gif': GIF})), [('a.gif', GIF)])
+
+    def test_zip_with_something_prepended(self):
+        # like a self-extracting archive, whose zip file comes after the program that extracts it
+        data = b'MZ' + bytes(1000) + make_zip({'a.gif': GIF})
+        self.assertIsNone(archive.archive_format(data[:archive.MAGIC_SIZE]))
+        self.assertEqual(extract(data), [('a.gif', GIF)])
+
+    def test_not_an_archive(self):
+        with self.assertRaises(errors.InvalidArchiveError):
+            extract(b'not an archive\n' * 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+# © lambda#0987 <lambda@lambda.dance>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import json
+import os
+import tempfile
+import unittest
+
+from utils import ec_index
+
+
+def emote(name):
+    return dict(
+        name=name, id=1, author=1, animated=False, created=None, modified=None,
+        preserve=False, description=None, nsfw='SFW')
+
+
+class TestSearch(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        source_path = os.path.join(directory.name, 'emotes.json')
+        index_path = os.path.join(directory.name, 'emotes.sqlite3')
+        with open(source_path, 'w') as f:
+            json.dump({name: emote(name) for name in ('Think', 'Thonk', 'ThinkingHard', 'blobcat')}, f)
+        ec_index.build(source_path, index_path)
+
+        self.index = ec_index.ECIndex(index_path, source_path=None)
+        self.addCleanup(self.index.close)
+
+    def test_prefix_matches_come_first(self):
+        names = [e['name'] for e in self.index.search('think')]
+        self.assertEqual(names[:2], ['Think', 'ThinkingHard'])
+        self.assertIn('Thonk', names)
+
+    def test_long_query(self):
+        # every character is different, so this has more trigrams than sqlite allows parameters (at most 250,000)
+        query = ''.join(map(chr, range(0x10000, 0x10000 + 300_000)))
+        self.assertEqual(self.index.search(query), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+# © lambda#0987 <lambda@lambda.dance>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import types
+import unittest
+
+from utils.emote_index import GuildEmoteIndex
+
+
+def emote(id, name, animated=False):
+    return types.SimpleNamespace(id=id, name=name, animated=animated)
+
+
+class TestGuildEmoteIndex(unittest.TestCase):
+    def setUp(self):
+        self.guild = types.SimpleNamespace(id=1, emojis=(emote(1, 'Think'), emote(2, 'blob', animated=True)))
+        self.index = GuildEmoteIndex()
+
+    def test_lookups(self):
+        self.assertEqual(self.index.get(self.guild, 2).name, 'blob')
+        self.assertEqual([e.id for e in self.index.named(self.guild, 'think')], [1])
+        self.assertEqual(self.index.slot_counts(self.guild), {False: 1, True: 1})
+
+    def test_pending_changes_survive_a_new_emote_list(self):
+        self.index.created(self.guild, 3, False)
+        self.index.deleted(self.guild, 2)
+        self.assertEqual(self.index.slot_counts(self.guild), {False: 2, True: 0})
+
+        # a reconnect replaces guild.emojis, without the changes above
+        self.guild.emojis = tuple(self.guild.emojis)[:1] + (emote(2, 'blob', animated=True),)
+        self.assertEqual(self.index.slot_counts(self.guild), {False: 2, True: 0})
+
+        # then the gateway catches up
+        self.guild.emojis = (emote(1, 'Think'), emote(3, 'new'))
+        self.assertEqual(self.index.slot_counts(self.guild), {False: 2, True: 0})
+        self.assertEqual(self.index.get(self.guild, 3).name, 'new')
+        self.assertIsNone(self.index.get(self.guild, 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+# © lambda#0987 <lambda@lambda.dance>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import random
+import unittest
+
+try:
+    import wand.image
+except ImportError:
+    wand = None
+
+import utils.image
+
+
+def make_gif(frames=8, size=128, seed=0):
+    """a GIF whose frames are each different noise, so that every frame needs a full palette."""
+    rng = random.Random(seed)
+    image = wand.image.Image()
+    for _ in range(frames):
+        n = size * size * 3
+        with wand.image.Image(width=size, height=size) as frame:
+            frame.import_pixels(
+                width=size, height=size, channel_map='RGB', storage='char',
+                data=rng.getrandbits(8 * n).to_bytes(n, 'little'))
+            image.sequence.append(frame)
+    image.format = 'gif'
+    return image
+
+
+@unittest.skipIf(wand is None, 'needs Wand and ImageMagick')
+class TestColorDepth(unittest.TestCase):
+    def test_every_frame_is_quantized(self):
+        with make_gif() as original:
+            utils.image.load_wand()
+            sizes = [len(utils.image._encode_resized(original, 128, depth)) for depth in utils.image.GIF_COLOR_DEPTHS]
+            smallest = utils.image._encode_resized(original, 128, utils.image.GIF_COLOR_DEPTHS[-1])
+
+        # each step down in colour depth makes the GIF smaller
+        self.assertEqual(sizes, sorted(sizes, reverse=True))
+        self.assertEqual(len(set(sizes)), len(sizes))
+
+        with wand.image.Image(blob=smallest) as encoded:
+            self.assertEqual(len(encoded.sequence), 8)
+            for frame in encoded.sequence:
+                with frame:
+                    self.assertLessEqual(frame.colors, utils.image.GIF_COLOR_DEPTHS[-1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+# © lambda#0987 <lambda@lambda.dance>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import asyncio
+import unittest
+
+from utils.scheduler import DownloadScheduler
+
+URL = 'https://cdn.discordapp.com/emojis/1.png'
+OTHER_HOST_URL = 'https://media.discordapp.net/emojis/1.png'
+
+
+class TestLimits(unittest.IsolatedAsyncioTestCase):
+    """each fake download appends ('start', name) once it has a slot, then holds it until its event is set"""
+
+    def setUp(self):
+        self.events = []
+
+    async def download(self, scheduler, name, url, guild_id, done: asyncio.Event):
+        async with scheduler.slot(url, guild_id):
+            self.events.append(('start', name))
+            await done.wait()
+            self.events.append(('end', name))
+
+    async def test_per_guild_limit_blocks_the_second_download(self):
+        scheduler = DownloadScheduler(max_in_flight=16, max_per_host=8, max_per_guild=1)
+        first_done, second_done, other_done = asyncio.Event(), asyncio.Event(), asyncio.Event()
+
+        first = asyncio.ensure_future(self.download(scheduler, 'first', URL, 1, first_done))
+        second = asyncio.ensure_future(self.download(scheduler, 'second', URL, 1, second_done))
+        other_guild = asyncio.ensure_future(self.download(scheduler, 'other guild', URL, 2, other_done))
+        await asyncio.sleep(0)
+        # another server is not held up by the first one's limit
+        self.assertEqual(self.events, [('start', 'first'), ('start', 'other guild')])
+
+        first_done.set()
+        await first
+        await asyncio.sleep(0)
+        self.assertEqual(self.events[2:], [('end', 'first'), ('start', 'second')])
+
+        second_done.set()
+        other_done.set()
+        await asyncio.gather(second, other_guild)
+
+    async def test_per_host_limit_blocks_the_second_download(self):
+        scheduler = DownloadScheduler(max_in_flight=16, max_per_host=1, max_per_guild=4)
+        first_done, second_done, other_done = asyncio.Event(), asyncio.Event(), asyncio.Event()
+
+        first = asyncio.ensure_future(self.download(scheduler, 'first', URL, 1, first_done))
+        # a different server, so only the host limit applies
+        second = asyncio.ensure_future(self.download(scheduler, 'second', URL, 2, second_done))
+        other_host = asyncio.ensure_future(self.download(scheduler, 'other host', OTHER_HOST_URL, 1, other_done))
+        await asyncio.sleep(0)
+        self.assertEqual(self.events, [('start', 'first'), ('start', 'other host')])
+
+        first_done.set()
+        await first
+        await asyncio.sleep(0)
+        self.assertEqual(self.events[2:], [('end', 'first'), ('start', 'second')])
+
+        second_done.set()
+        other_done.set()
+        await asyncio.gather(second, other_host)
+
+    async def test_slot_is_released_after_an_exception(self):
+        scheduler = DownloadScheduler(max_in_flight=1)
+        failing = asyncio.Event()
+
+        async def fail():
+            async with scheduler.slot(URL, guild_id=1):
+                self.events.append(('start', 'failing'))
+                await failing.wait()
+                raise OSError('connection reset')
+
+        done = asyncio.Event()
+        first = asyncio.ensure_future(fail())
+        second = asyncio.ensure_future(self.download(scheduler, 'second', URL, 1, done))
+        await asyncio.sleep(0)
+        self.assertEqual(self.events, [('start', 'failing')])
+
+        failing.set()
+        with self.assertRaises(OSError):
+            await first
+        await asyncio.sleep(0)
+        self.assertEqual(self.events, [('start', 'failing'), ('start', 'second')])
+
+        done.set()
+        await asyncio.wait_for(second, 1)
+
+
+class TestCancellation(unittest.IsolatedAsyncioTestCase):
+    async def test_cancelled_waiters_are_not_charged(self):
+        scheduler = DownloadScheduler(max_in_flight=16, max_per_host=8, max_per_guild=4)
+        release = asyncio.Event()
+
+        async def download():
+            async with scheduler.slot(URL, guild_id=1):
+                await release.wait()
+
+        running = [scheduler.slot(URL, guild_id=1) for _ in range(4)]
+        for slot in running:
+            await slot.__aenter__()
+        queued = [asyncio.ensure_future(download()) for _ in range(10)]
+        await asyncio.sleep(0)
+        self.assertEqual(scheduler.stats()['in_flight'], 4)
+        self.assertEqual(scheduler.queue_depth, 10)
+
+        # cancel the queued downloads, and free up slots for them before they've noticed
+        for task in queued:
+            task.cancel()
+        for slot in running:
+            await slot.__aexit__(None, None, None)
+        await asyncio.gather(*queued, return_exceptions=True)
+
+        self.assertEqual(scheduler._in_flight, 0)
+        self.assertFalse(scheduler._hosts)
+        self.assertFalse(scheduler._guilds)
+        self.assertEqual(scheduler.queue_depth, 0)
+
+        # and the guild can still download
+        release.set()
+        await asyncio.wait_for(download(), 1)
+
+    async def test_cancelled_after_being_given_a_slot(self):
+        scheduler = DownloadScheduler(max_in_flight=1)
+        release = asyncio.Event()
+
+        async def download():
+            async with scheduler.slot(URL, guild_id=1):
+                await release.wait()
+
+        first = scheduler.slot(URL, guild_id=1)
+        await first.__aenter__()
+        second = asyncio.ensure_future(download())
+        await asyncio.sleep(0)
+
+        # hands the slot to second, which is cancelled before it gets to run
+        await first.__aexit__(None, None, None)
+        second.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await second
+
+        self.assertEqual(scheduler._in_flight, 0)
+        self.assertFalse(scheduler._guilds)
+
+
+if __name__ == '__main__':
+    unittest.main()
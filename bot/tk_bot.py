@@ -1,11 +1,23 @@
 from __future__ import annotations
 
-from typing import Optional, List
+import logging
+from typing import Optional, List, Sequence
 
 import discord
 from discord.ext import commands
 
+from utils import tracing
+
 from .config import Config
+from .startup import StartupReport
+
+logger = logging.getLogger(__name__)
+
+
+class Context(commands.Context):
+    async def send(self, *args, **kwargs):
+        with tracing.span('send'):
+            return await super().send(*args, **kwargs)
 
 
 class TKBot(commands.AutoShardedBot):
@@ -16,6 +28,7 @@ class TKBot(commands.AutoShardedBot):
         activity: discord.Activity,
         shard_count: Optional[int],
         shard_ids: Optional[List[int]],
+        startup: StartupReport,
     ):
         super().__init__(
             command_prefix=config.DEFAULT_PREFIX,
@@ -29,3 +42,36 @@ class TKBot(commands.AutoShardedBot):
         )
 
         self.config = config
+        self.startup = startup
+        # loaded once the first shard is ready, so that they don't hold up connecting
+        self.deferred_extensions: Sequence[str] = ()
+
+    def load_extensions(self, names):
+        for name in names:
+            logger.info(f"Loading {name}...")
+            with self.startup.timed(name):
+                self.load_extension(name)
+
+    async def get_context(self, message, *, cls=Context):
+        return await super().get_context(message, cls=cls)
+
+    async def invoke(self, context):
+        if context.command is None:
+            return await super().invoke(context)
+
+        with tracing.trace(
+            'command ' + context.command.qualified_name,
+            sample_rate=self.config.trace_sample_rate,
+            guild=context.guild and context.guild.id,
+            message=context.message.id,
+        ):
+            await super().invoke(context)
+
+    async def on_shard_ready(self, shard_id):
+        if not self.startup.shard_ready():
+            return
+
+        self.load_extensions(self.deferred_extensions)
+        if self.startup.import_timer is not None:
+            self.startup.import_timer.uninstall()
+        logger.info('Startup report:\n%s', self.startup.format())
@@ -10,13 +10,23 @@ from .misc import (
 from . import archive
 from . import emote
 from . import errors
+from . import metrics
+from . import output
 from . import paginator
+from . import pipeline
+from . import sniff
+from . import tracing
 
 __all__ = (
     archive,
     emote,
     errors,
+    metrics,
+    output,
     paginator,
+    pipeline,
+    sniff,
+    tracing,
     format_user,
     format_http_exception,
     strip_angle_brackets,
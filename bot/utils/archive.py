@@ -3,81 +3,240 @@
 
 import asyncio
 import collections
+import concurrent.futures
+import contextlib
+import functools
 import logging
 import tarfile
 import typing.io
 import zipfile
+import zlib
 from typing import Iterable, Tuple, Optional
 
-from . import errors
+from . import errors, sniff, tracing
 
 ArchiveInfo = collections.namedtuple('ArchiveInfo', 'filename content error')
 
+# (offset, magic bytes, format). the format of a tar file is its compression, as in tarfile.open's mode
+MAGIC = (
+    (0, b'PK\x03\x04', 'zip'),
+    (0, b'PK\x05\x06', 'zip'),  # empty
+    (0, b'\x1f\x8b', 'gz'),
+    (0, b'BZh', 'bz2'),
+    (0, b'\xfd7zXZ\x00', 'xz'),
+    (257, b'ustar', ''),
+)
+MAGIC_SIZE = max(offset + len(magic) for offset, magic, _ in MAGIC)
+
+# an archive may not decompress to more than this many bytes in total
+TOTAL_SIZE_LIMIT = 250_000_000
+# nor to more than this many times its compressed size, once it's past RATIO_GRACE bytes.
+# images don't compress, so only a bomb gets anywhere near this
+MAX_COMPRESSION_RATIO = 100
+RATIO_GRACE = 1_000_000
+
+
+def archive_format(head: bytes) -> Optional[str]:
+    """Guess the format of an archive from its first MAGIC_SIZE bytes.
+
+    Returns 'zip', or the compression of a tar file ('', 'gz', 'bz2' or 'xz'), or None if it's not recognized.
+    """
+    for offset, magic, format in MAGIC:
+        if head[offset:offset + len(magic)] == magic:
+            return format
+    return None
+
+
+def check_expansion(uncompressed, compressed, *, total_limit, max_ratio):
+    """Raise errors.ArchiveBombError if uncompressed bytes of output from compressed bytes of input is too much."""
+    if total_limit is not None and uncompressed > total_limit:
+        raise errors.ArchiveBombError
+    if max_ratio is not None and uncompressed > RATIO_GRACE and uncompressed > max_ratio * max(compressed, 1):
+        raise errors.ArchiveBombError
+
 
 def extract(
     archive: typing.io.BinaryIO,
-    *, size_limit=None
+    *, size_limit=None, total_limit=TOTAL_SIZE_LIMIT, max_ratio=MAX_COMPRESSION_RATIO, images_only=False,
 ) -> Iterable[Tuple[str, Optional[bytes], Optional[BaseException]]]:
     """
-    extract a binary file-like object representing a zip or uncompressed tar archive, yielding filenames and contents.
+    extract a binary file-like object representing a zip or tar archive, yielding filenames and contents.
+    tar archives may be compressed with gzip, bzip2 or xz. they are read as a stream, one member at a time.
 
     yields ArchiveInfo objects: (filename: str, content: typing.Optional[bytes], error: )
     if size_limit is not None and the size limit is exceeded, or for any other error, yield None for content
     on success, error will be None
+
+    if images_only, members that aren't GIF, PNG, JPEG or WEBP images are skipped, judging by their first few bytes,
+    so that they are never decompressed in full. so is anything in a __MACOSX directory, and the like.
+    only images are reported as being over size_limit.
+    images with more than sniff.MAX_PIXELS pixels, according to their headers, yield errors.ImageTooLargeError.
+
+    raises errors.InvalidArchiveError if the archive is not one of those formats or is corrupt,
+    and errors.ArchiveBombError if it decompresses to more than total_limit bytes
+    or to more than max_ratio times its compressed size.
     """
+    start = archive.tell()
+    format = archive_format(archive.read(MAGIC_SIZE))
+    # zip files are read from the end, so self-extracting ones, and others with something in front, still work
+    if format is None and zipfile.is_zipfile(archive):
+        format = 'zip'
+    archive.seek(start)
 
+    limits = dict(size_limit=size_limit, total_limit=total_limit, max_ratio=max_ratio, images_only=images_only)
     try:
-        yield from extract_zip(archive, size_limit=size_limit)
-        return
-    except zipfile.BadZipFile:
-        pass
+        if format == 'zip':
+            yield from extract_zip(archive, **limits)
+        else:
+            # very old tar files have no magic number, so give anything unrecognized a chance as a tar file
+            yield from extract_tar(archive, compression=format or '', **limits)
+    except (zipfile.BadZipFile, tarfile.TarError, EOFError) as exc:
+        raise errors.InvalidArchiveError from exc
     finally:
-        archive.seek(0)
+        archive.seek(start)
+
+
+class _Expansion:
+    """tallies how much of an archive has been decompressed, raising errors.ArchiveBombError once it's too much"""
+
+    def __init__(self, *, total_limit, max_ratio):
+        self.total_limit = total_limit
+        self.max_ratio = max_ratio
+        self.uncompressed = 0
+        self.compressed = 0
+
+    def add(self, uncompressed, compressed):
+        self.uncompressed += uncompressed
+        self.compressed += compressed
+        check_expansion(self.uncompressed, self.compressed, total_limit=self.total_limit, max_ratio=self.max_ratio)
 
-    try:
-        yield from extract_tar(archive, size_limit=size_limit)
-    except tarfile.ReadError as exc:
-        raise ValueError('not a valid zip or tar file') from exc
-    finally:
-        archive.seek(0)
 
+def read_member(
+    filename, fp, size, *, size_limit=None, images_only=False, before_read=None,
+) -> Optional[ArchiveInfo]:
+    """read an archive member of size bytes from fp.
 
-def extract_zip(archive, *, size_limit=None):
+    if images_only and it isn't an image, return None after reading only its head,
+    so that members which aren't images are skipped quietly, however big they are.
+    before_read, if given, is called before the member is read in full.
+    """
+    head = b''
+    if images_only:
+        head = fp.read(sniff.HEAD_SIZE)
+        header = sniff.sniff(head)
+        if header is None:
+            return None
+        pixels = sniff.pixels(header)
+        if pixels is not None and pixels > sniff.MAX_PIXELS:
+            return ArchiveInfo(
+                filename,
+                content=None,
+                error=errors.ImageTooLargeError(header.width, header.height, sniff.MAX_PIXELS))
+
+    if size_limit is not None and size >= size_limit:
+        return ArchiveInfo(filename=filename, content=None, error=errors.FileTooBigError(size, size_limit))
+
+    if before_read is not None:
+        before_read()
+    return ArchiveInfo(filename, content=head + fp.read(), error=None)
+
+
+def extract_zip(archive, *, size_limit=None, total_limit=None, max_ratio=None, images_only=False):
     with zipfile.ZipFile(archive) as zip:
         members = [m for m in zip.infolist() if not m.is_dir()]
+        # zip files are read at random, so only the members we actually decompress count
+        expansion = _Expansion(total_limit=total_limit, max_ratio=max_ratio)
         for member in members:
-            if size_limit is not None and member.file_size >= size_limit:
-                yield ArchiveInfo(
-                    filename=member.filename,
-                    content=None,
-                    error=errors.FileTooBigError(member.file_size, size_limit))
+            if images_only and sniff.is_junk(member.filename):
                 continue
 
+            # zipfile never decompresses more than file_size bytes of a member, so it can be trusted.
+            # (the heads of members that aren't images go uncounted, but there's at most sniff.HEAD_SIZE of each)
+            charge = functools.partial(expansion.add, member.file_size, member.compress_size)
             try:
-                content = zip.open(member).read()
-            except RuntimeError as exc:  # why no specific exceptions smh
+                with zip.open(member) as fp:
+                    info = read_member(
+                        member.filename, fp, member.file_size,
+                        size_limit=size_limit, images_only=images_only, before_read=charge)
+            except (RuntimeError, zipfile.BadZipFile, zlib.error) as exc:  # why no specific exceptions smh
                 yield ArchiveInfo(filename=member.filename, content=None, error=exc)
             else:  # this else is required to avoid UnboundLocalError for some reason
-                yield ArchiveInfo(filename=member.filename, content=content, error=None)
+                if info is not None:
+                    yield info
 
 
-def extract_tar(archive, *, size_limit=None):
-    with tarfile.open(fileobj=archive) as tar:
-        members = [f for f in tar.getmembers() if f.isfile()]
-        for member in members:
-            if size_limit is not None and member.size >= size_limit:
-                yield ArchiveInfo(
-                    filename=member.name,
-                    content=None,
-                    error=errors.FileTooBigError(member.size, size_limit))
+def extract_tar(archive, *, compression='', size_limit=None, total_limit=None, max_ratio=None, images_only=False):
+    start = archive.tell()
+    # stream mode never seeks, so nothing is decompressed twice, and the members are never all held in memory
+    with tarfile.open(fileobj=archive, mode='r|' + compression) as tar:
+        for member in tar:
+            # skipping a member in a stream still means decompressing it, so the limits apply to every byte.
+            # the total is checked against the size in its header before anything is decompressed,
+            # and the ratio against what's been decompressed so far
+            end = member.offset_data + member.size
+            check_expansion(end, 0, total_limit=total_limit, max_ratio=None)
+            if compression:
+                check_expansion(member.offset, archive.tell() - start, total_limit=None, max_ratio=max_ratio)
+            if not member.isfile() or images_only and sniff.is_junk(member.name):
+                continue
+
+            info = read_member(
+                member.name, tar.extractfile(member), member.size, size_limit=size_limit, images_only=images_only)
+            if info is None:
                 continue
+            if compression and info.content is not None:
+                # don't hold on to the member if it was a bomb
+                check_expansion(end, archive.tell() - start, total_limit=None, max_ratio=max_ratio)
+            yield info
 
-            yield ArchiveInfo(member.name, content=tar.extractfile(member).read(), error=None)
+
+async def extract_async(
+    archive: typing.io.BinaryIO, size_limit=None,
+    *, total_limit=TOTAL_SIZE_LIMIT, max_ratio=MAX_COMPRESSION_RATIO, images_only=False, buffer_size=4,
+):
+    """
+    extract an archive like extract(), but decompress it in a worker thread so that the event loop is not blocked.
+
+    at most buffer_size members are extracted ahead of the consumer.
+    """
+    loop = asyncio.get_event_loop()
+    members = extract(
+        archive, size_limit=size_limit, total_limit=total_limit, max_ratio=max_ratio, images_only=images_only)
+    # a single thread ensures that the generator is never resumed concurrently, even after cancellation
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='extract')
+    queue = asyncio.Queue(maxsize=buffer_size)
+    done = object()
+
+    async def produce():
+        try:
+            while True:
+                with tracing.span('extract'):
+                    member = await loop.run_in_executor(executor, next, members, done)
+                await queue.put(member)
+                if member is done:
+                    return
+        except Exception as exc:
+            await queue.put(_ExtractionError(exc))
+
+    producer = asyncio.ensure_future(produce())
+    try:
+        while True:
+            member = await queue.get()
+            if member is done:
+                return
+            if isinstance(member, _ExtractionError):
+                raise member.exc
+            yield member
+    finally:
+        producer.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await producer
+        await loop.run_in_executor(executor, members.close)
+        executor.shutdown(wait=False)
 
 
-async def extract_async(archive: typing.io.BinaryIO, size_limit=None):
-    for x in extract(archive, size_limit=size_limit):
-        yield await asyncio.sleep(0, x)
+class _ExtractionError(typing.NamedTuple):
+    exc: BaseException
 
 
 def main():
@@ -0,0 +1,168 @@
+# © lambda#0987 <lambda@lambda.dance>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+"""a two tier (memory and disk) LRU cache for immutable blobs"""
+
+import asyncio
+import collections
+import contextlib
+import logging
+import os
+import tempfile
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class ByteCache:
+    """An LRU cache of bytes, capped by total size rather than number of entries.
+
+    Recently used entries are kept in memory, up to memory_limit bytes.
+    If disk_path is given, entries are also written there, up to disk_limit bytes,
+    so that they survive eviction from memory and restarts.
+    Disk I/O is done in the default executor.
+
+    Keys must be usable as file names.
+    """
+
+    def __init__(self, *, memory_limit: int, disk_path: Optional[str] = None, disk_limit: int = 0):
+        self.memory_limit = memory_limit
+        self.disk_path = disk_path
+        self.disk_limit = disk_limit
+
+        self._memory = collections.OrderedDict()
+        self._memory_size = 0
+        # key → size, least recently used first
+        self._disk = collections.OrderedDict()
+        self._disk_size = 0
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if self.disk_path is not None:
+            os.makedirs(self.disk_path, exist_ok=True)
+            self._load_disk_index()
+
+    @property
+    def hits(self):
+        return self.memory_hits + self.disk_hits
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'memory_entries': len(self._memory),
+            'memory_bytes': self._memory_size,
+            'disk_entries': len(self._disk),
+            'disk_bytes': self._disk_size,
+        }
+
+    def _load_disk_index(self):
+        entries = []
+        with os.scandir(self.disk_path) as it:
+            for entry in it:
+                if entry.is_file() and not entry.name.startswith('.'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, entry.name, stat.st_size))
+
+        # files are touched when they are read, so mtime order is LRU order
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self._disk_size += size
+
+        self._unlink_files(self._evict_disk())
+
+    async def get(self, key: str) -> Optional[bytes]:
+        try:
+            value = self._memory[key]
+        except KeyError:
+            pass
+        else:
+            self._memory.move_to_end(key)
+            self.memory_hits += 1
+            return value
+
+        if key in self._disk:
+            self._disk.move_to_end(key)
+            loop = asyncio.get_event_loop()
+            value = await loop.run_in_executor(None, self._read_file, key)
+            if value is not None:
+                self.disk_hits += 1
+                self._put_memory(key, value)
+                return value
+
+            # somebody deleted it out from under us
+            self._disk_size -= self._disk.pop(key, 0)
+
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, value: bytes):
+        self._put_memory(key, value)
+
+        if self.disk_path is None or len(value) > self.disk_limit:
+            return
+
+        loop = asyncio.get_event_loop()
+        try:
+            await loop.run_in_executor(None, self._write_file, key, value)
+        except OSError:
+            logger.exception('failed to write %s to the disk cache', key)
+            return
+
+        self._disk_size += len(value) - self._disk.pop(key, 0)
+        self._disk[key] = len(value)
+        evicted = self._evict_disk()
+        if evicted:
+            await loop.run_in_executor(None, self._unlink_files, evicted)
+
+    def _put_memory(self, key, value):
+        if len(value) > self.memory_limit:
+            return
+
+        self._memory_size += len(value) - len(self._memory.pop(key, b''))
+        self._memory[key] = value
+        while self._memory_size > self.memory_limit:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_size -= len(evicted)
+
+    def _evict_disk(self):
+        """drop entries from the disk index until it fits in disk_limit, returning the keys whose files to delete."""
+        evicted = []
+        while self._disk_size > self.disk_limit:
+            key, size = self._disk.popitem(last=False)
+            self._disk_size -= size
+            evicted.append(key)
+        return evicted
+
+    def _read_file(self, key):
+        path = os.path.join(self.disk_path, key)
+        try:
+            with open(path, 'rb') as f:
+                value = f.read()
+        except FileNotFoundError:
+            return None
+
+        with contextlib.suppress(OSError):
+            os.utime(path)
+        return value
+
+    def _write_file(self, key, value):
+        # write to a temporary file first so that readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.disk_path, prefix='.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(value)
+            os.replace(tmp_path, os.path.join(self.disk_path, key))
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.unlink(tmp_path)
+            raise
+
+    def _unlink_files(self, keys):
+        for key in keys:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(os.path.join(self.disk_path, key))
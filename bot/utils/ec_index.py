@@ -0,0 +1,249 @@
+# © lambda#0987 <lambda@lambda.dance>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+"""
+an on-disk index of the Emote Collector database, so that it doesn't have to be held in memory by every shard
+
+build it with python -m utils.ec_index [source JSON] [index]
+
+besides exact lookups by name, the index supports prefix search (a range scan of the primary key)
+and fuzzy search, which ranks names by how many trigrams they share with the query
+"""
+
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+from typing import Optional
+
+from . import errors
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SOURCE_PATH = 'data/ec-emotes-final.json'
+DEFAULT_INDEX_PATH = 'data/ec-emotes.sqlite3'
+
+# bump this whenever the schema changes so that old indexes get rebuilt
+SCHEMA_VERSION = 2
+
+SCHEMA = """
+CREATE TABLE emotes(
+    key TEXT PRIMARY KEY,  -- lowercased name
+    name TEXT NOT NULL,
+    id TEXT NOT NULL,
+    author TEXT NOT NULL,
+    animated INTEGER NOT NULL,
+    created INTEGER,
+    modified INTEGER,
+    preserve INTEGER NOT NULL,
+    description TEXT,
+    nsfw TEXT NOT NULL,
+    trigram_count INTEGER NOT NULL
+) WITHOUT ROWID;
+
+CREATE TABLE trigrams(
+    trigram TEXT NOT NULL,
+    key TEXT NOT NULL,
+    PRIMARY KEY (trigram, key)
+) WITHOUT ROWID;
+"""
+
+FIELDS = ('name', 'id', 'author', 'animated', 'created', 'modified', 'preserve', 'description', 'nsfw')
+BOOLEAN_FIELDS = {'animated', 'preserve'}
+
+# fuzzy matches that share less than this fraction of their trigrams with the query are not worth suggesting
+MIN_SIMILARITY = 0.3
+# no emote name is longer than this. it also bounds how many trigrams, and so SQL parameters, a search uses
+MAX_QUERY_LENGTH = 32
+
+
+def trigrams(name):
+    """Return the set of trigrams of name, padded so that the start and end of the name count for more."""
+    padded = f'  {name.lower()} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def build(source_path=DEFAULT_SOURCE_PATH, index_path=DEFAULT_INDEX_PATH):
+    """Build the index at index_path from the JSON export of the Emote Collector database at source_path."""
+    with open(source_path) as f:
+        emotes = json.load(f)
+
+    directory = os.path.dirname(index_path) or '.'
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.ec-index-')
+    os.close(fd)
+    try:
+        with contextlib.closing(sqlite3.connect(tmp_path)) as db:
+            db.executescript(SCHEMA)
+            db.executemany(
+                f'INSERT INTO emotes VALUES (?, {", ".join("?" * len(FIELDS))}, ?)',
+                (
+                    (emote['name'].lower(), *(emote[field] for field in FIELDS), len(trigrams(emote['name'])))
+                    for emote in emotes.values()
+                ))
+            db.executemany(
+                'INSERT INTO trigrams VALUES (?, ?)',
+                (
+                    (trigram, emote['name'].lower())
+                    for emote in emotes.values()
+                    for trigram in trigrams(emote['name'])
+                ))
+            db.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+            db.commit()
+            db.execute('VACUUM')
+        os.chmod(tmp_path, 0o644)
+        # several shard processes may build at once, so swap the finished index in atomically
+        os.replace(tmp_path, index_path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.unlink(tmp_path)
+        raise
+
+    logger.info('built the Emote Collector index with %s emotes at %s', len(emotes), index_path)
+
+
+def is_stale(source_path, index_path):
+    try:
+        index_mtime = os.stat(index_path).st_mtime
+    except FileNotFoundError:
+        return True
+    if source_path is not None and os.stat(source_path).st_mtime > index_mtime:
+        return True
+
+    with contextlib.closing(sqlite3.connect(f'file:{index_path}?mode=ro', uri=True)) as db:
+        (version,), = db.execute('PRAGMA user_version')
+    return version != SCHEMA_VERSION
+
+
+class ECIndex:
+    """Read-only, case-insensitive lookup of Emote Collector emotes by name.
+
+    Nothing is read until the first lookup. If source_path is given and the index is missing or out of date,
+    build_if_stale() (re)builds it from source_path in a worker thread. Until an index exists,
+    lookups raise errors.ECIndexUnavailableError.
+    Entries are dicts with the same fields as the JSON export.
+    """
+
+    def __init__(self, index_path=DEFAULT_INDEX_PATH, *, source_path: Optional[str] = DEFAULT_SOURCE_PATH):
+        self.index_path = index_path
+        self.source_path = source_path
+        self._db = None
+        self._building = False
+
+    async def build_if_stale(self):
+        """Rebuild the index from source_path if it's missing or out of date, without blocking the event loop."""
+        if self.source_path is None:
+            return
+        self._building = True
+        try:
+            await asyncio.get_event_loop().run_in_executor(None, self._build_if_stale)
+        finally:
+            self._building = False
+
+    def _build_if_stale(self):
+        if is_stale(self.source_path, self.index_path):
+            logger.info('building the Emote Collector index at %s', self.index_path)
+            build(self.source_path, self.index_path)
+
+    @property
+    def db(self):
+        if self._db is None:
+            # building it here would freeze the event loop, and opening it mid build would see the old one
+            if self._building:
+                raise errors.ECIndexUnavailableError(
+                    "Emote Collector's database is still being loaded. Please try again in a minute.")
+            if not os.path.exists(self.index_path):
+                logger.error(
+                    'the Emote Collector index %s is missing. build it with python -m utils.ec_index',
+                    self.index_path)
+                raise errors.ECIndexUnavailableError("Emote Collector's database is not available right now.")
+
+            self._db = sqlite3.connect(f'file:{self.index_path}?mode=ro', uri=True)
+            # the index is small and lookups are rare, so don't let sqlite cache much of it
+            self._db.execute('PRAGMA cache_size = -256')
+        return self._db
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def __getitem__(self, name):
+        row = self.db.execute(
+            f'SELECT {", ".join(FIELDS)} FROM emotes WHERE key = ?', (name.lower(),)
+        ).fetchone()
+        if row is None:
+            raise KeyError(name)
+        return self._to_dict(row)
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def search(self, query, *, limit=10):
+        """Return up to limit emotes whose names are close to query, best matches first.
+
+        Names that start with query come first, shortest first, followed by names ranked by trigram similarity.
+        """
+        key = query.strip(':').lower()[:MAX_QUERY_LENGTH]
+        if not key:
+            return []
+
+        columns = ', '.join(FIELDS)
+        # every key that starts with key sorts between key and key followed by the highest code point
+        prefix_matches = self.db.execute(
+            f'SELECT {columns} FROM emotes WHERE key >= ? AND key < ? ORDER BY length(key), key LIMIT ?',
+            (key, key + '\U0010ffff', limit),
+        ).fetchall()
+
+        results = list(map(self._to_dict, prefix_matches))
+        if len(results) >= limit:
+            return results
+
+        query_trigrams = trigrams(key)
+        seen = {emote['name'].lower() for emote in results}
+        fuzzy_matches = self.db.execute(
+            f"""
+            SELECT {columns} FROM (
+                SELECT key, COUNT(*) AS shared FROM trigrams
+                WHERE trigram IN ({", ".join("?" * len(query_trigrams))})
+                GROUP BY key
+            ) AS matches NATURAL JOIN emotes
+            WHERE CAST(shared AS REAL) / (trigram_count + ? - shared) >= ?
+            ORDER BY CAST(shared AS REAL) / (trigram_count + ? - shared) DESC, key
+            LIMIT ?
+            """,
+            (*query_trigrams, len(query_trigrams), MIN_SIMILARITY, len(query_trigrams), limit + len(seen)),
+        ).fetchall()
+
+        for row in fuzzy_matches:
+            emote = self._to_dict(row)
+            if emote['name'].lower() not in seen:
+                results.append(emote)
+        return results[:limit]
+
+    def __len__(self):
+        (count,), = self.db.execute('SELECT COUNT(*) FROM emotes')
+        return count
+
+    @staticmethod
+    def _to_dict(row):
+        emote = dict(zip(FIELDS, row))
+        for field in BOOLEAN_FIELDS:
+            emote[field] = bool(emote[field])
+        return emote
+
+
+def main():
+    import sys
+
+    logging.basicConfig(level=logging.INFO)
+    build(*sys.argv[1:3])
+
+
+if __name__ == '__main__':
+    main()
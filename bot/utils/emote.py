@@ -13,8 +13,26 @@ RE_EMOTE = re.compile(r'(:|;)(?P<name>\w{2,32})\1|(?P<newline>\n)', re.ASCII)
 """Matches only custom server emotes."""
 RE_CUSTOM_EMOTE = re.compile(r'<(?P<animated>a?):(?P<name>\w{2,32}):(?P<id>\d{17,})>', re.ASCII)
 
+"""Matches the full size image URL of an emote on Discord's CDN."""
+RE_CDN_URL = re.compile(
+    r'https://cdn\.discordapp\.(?:com|net)/emojis/(?P<id>\d{17,})\.(?P<extension>png|gif|webp)(?:\?v=1)?',
+    re.ASCII)
+
 
 def url(id, *, animated: bool = False):
     """Convert an emote ID to the image URL for that emote."""
     extension = 'gif' if animated else 'png'
     return f'https://cdn.discordapp.com/emojis/{id}.{extension}?v=1'
+
+
+def cdn_cache_key(url):
+    """Return a key identifying the image at an emote CDN URL, or None if the URL is not one.
+
+    Discord doesn't let an emote's image be replaced (only re-uploaded under a new ID), so it never changes.
+    Anything fetched from such a URL, or derived from it, can therefore be cached forever.
+    """
+    match = RE_CDN_URL.fullmatch(url)
+    if match is None:
+        return None
+    # the extension also tells us whether the emote is animated
+    return f'{match["id"]}.{match["extension"]}'
@@ -2,19 +2,26 @@
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
 import json
-import asyncio
 import aiohttp
+import binascii
 import datetime
 import urllib.parse
 from typing import Dict
 from http import HTTPStatus
 from discord import PartialEmoji
 import utils.image as image_utils
+from utils import metrics, tracing
 from utils.errors import RateLimitedError
+from utils.ratelimit import RateLimiter, route_for
 from discord import HTTPException, Forbidden, NotFound, DiscordServerError
 
 GuildId = int
 
+REQUEST_SECONDS = metrics.histogram(
+    'emote_manager_discord_request_seconds',
+    'Time taken by requests to the Discord API, including rate limit waits, by method and route',
+    ('method', 'route'))
+
 
 async def json_or_text(resp):
     text = await resp.text(encoding='utf-8')
@@ -28,6 +35,37 @@ async def json_or_text(resp):
     return text
 
 
+# a multiple of 3, so that only the final chunk of base64 is padded
+BASE64_CHUNK_SIZE = 3 * 2**12
+
+
+def create_emote_body(name, image: bytes, role_ids=()) -> bytearray:
+    """Build the JSON body of a Create Guild Emoji request.
+
+    The image is base64 encoded in small chunks straight into a buffer of the final size,
+    rather than building a data URL string and then serializing it to JSON again.
+    """
+    mime = image_utils.mime_type_for_image(image)
+    # the data URL goes last so that the other fields can be serialized by json.dumps
+    head = json.dumps(dict(name=name, roles=list(role_ids)))[:-1] + f', "image": "data:{mime};base64,'
+    head = head.encode('utf-8')
+    tail = b'"}'
+
+    encoded_size = 4 * ((len(image) + 2) // 3)
+    body = bytearray(len(head) + encoded_size + len(tail))
+    body[:len(head)] = head
+
+    image = memoryview(image)
+    pos = len(head)
+    for start in range(0, len(image), BASE64_CHUNK_SIZE):
+        encoded = binascii.b2a_base64(image[start:start + BASE64_CHUNK_SIZE], newline=False)
+        body[pos:pos + len(encoded)] = encoded
+        pos += len(encoded)
+
+    body[pos:] = tail
+    return body
+
+
 class EmoteClient:
     BASE_URL = 'https://discord.com/api/v7'
     HTTP_ERROR_CLASSES = {
@@ -35,9 +73,13 @@ class EmoteClient:
         HTTPStatus.NOT_FOUND: NotFound,
         HTTPStatus.SERVICE_UNAVAILABLE: DiscordServerError,
     }
+    # we've been hit with one of those crazy high rate limits, which only occur for specific methods,
+    # if we would have to wait this long
+    MAX_RL_SLEEP = 10.0
 
     def __init__(self, bot):
         self.guild_rls: Dict[GuildId, float] = {}
+        self.limiter = RateLimiter(max_wait=self.MAX_RL_SLEEP)
         self.http = aiohttp.ClientSession(headers={
             'User-Agent': bot.config.user_agent + ' ' + bot.http.user_agent,
             'Authorization': 'Bot ' + bot.config.DISCORD_TOKEN,  # TODO: Required bot token under 'Bot' + 'Token'
@@ -45,26 +87,34 @@ class EmoteClient:
         })
 
     async def request(self, method, path, guild_id, **kwargs):
-        self.check_rl(guild_id)
-
-        headers = {}
+        headers = kwargs.pop('headers', {})
         # Emote Manager shouldn't use walrus op until Debian adopts 3.8 :(
         reason = kwargs.pop('reason', None)
         if reason:
             headers['X-Audit-Log-Reason'] = urllib.parse.quote(reason, safe='/ ')
         kwargs['headers'] = headers
 
-        # TODO handle OSError and 500/502, like dpy does
-        async with self.http.request(method, self.BASE_URL + path, **kwargs) as resp:
-            if resp.status == HTTPStatus.TOO_MANY_REQUESTS:
-                return await self._handle_rl(resp, method, path, guild_id, **kwargs)
+        route = route_for(method, path)
+        with REQUEST_SECONDS.labels(*route).time(), tracing.span('discord request', method=method, route=route[1]):
+            while True:
+                with tracing.span('rate limit wait'):
+                    await self.limiter.acquire(route, guild_id)
+
+                # TODO handle OSError and 500/502, like dpy does
+                async with self.http.request(method, self.BASE_URL + path, **kwargs) as resp:
+                    self.limiter.update(route, guild_id, resp.headers)
+                    tracing.annotate(status=resp.status)
+                    if resp.status == HTTPStatus.TOO_MANY_REQUESTS:
+                        await self._handle_rl(resp, route, guild_id)
+                        # try again once the limiter says we can
+                        continue
 
-            data = await json_or_text(resp)
-            if resp.status in range(200, 300):
-                return data
+                    data = await json_or_text(resp)
+                    if resp.status in range(200, 300):
+                        return data
 
-            error_cls = self.HTTP_ERROR_CLASSES.get(resp.status, HTTPException)
-            raise error_cls(resp, data)
+                    error_cls = self.HTTP_ERROR_CLASSES.get(resp.status, HTTPException)
+                    raise error_cls(resp, data)
 
     # optimization method that lets us check the RL before downloading the user's image.
     # also lets us preemptively check the RL before doing a request
@@ -72,39 +122,40 @@ class EmoteClient:
         try:
             retry_at = self.guild_rls[guild_id]
         except KeyError:
-            return
-
-        now = datetime.datetime.now(tz=datetime.timezone.utc).timestamp()
-        if retry_at < now:
+            pass
+        else:
+            now = datetime.datetime.now(tz=datetime.timezone.utc).timestamp()
+            if retry_at >= now:
+                raise RateLimitedError(retry_at)
             del self.guild_rls[guild_id]
-            return
-
-        raise RateLimitedError(retry_at)
 
-    async def _handle_rl(self, resp, method, path, guild_id, **kwargs):
-        retry_after = (await resp.json())['retry_after'] / 1000.0
-        retry_at = datetime.datetime.now(tz=datetime.timezone.utc) + datetime.timedelta(seconds=retry_after)
+        self.limiter.check(route_for('POST', f'/guilds/{guild_id}/emojis'), guild_id)
 
-        # cache unconditionally in case request() is called again while we're sleeping
-        self.guild_rls[guild_id] = retry_at.timestamp()
-
-        if retry_after < 10.0:
-            await asyncio.sleep(retry_after)
-            # woo mutual recursion
-            return await self.request(method, path, guild_id, **kwargs)
-
-        # we've been hit with one of those crazy high rate limits, which only occur for specific methods
-        raise RateLimitedError(retry_at)
+    async def _handle_rl(self, resp, route, guild_id):
+        body = await resp.json()
+        retry_after = body['retry_after'] / 1000.0
+        is_global = body.get('global', False) or 'X-RateLimit-Global' in resp.headers
+        self.limiter.limited(route, guild_id, retry_after, is_global=is_global)
 
     async def create(self, *, guild, name, image: bytes, role_ids=(), reason=None):
-        data = await self.request(
-            'POST', f'/guilds/{guild.id}/emojis',
-            guild.id,
-            json=dict(name=name, image=image_utils.image_to_base64_url(image), roles=role_ids),
-            reason=reason,
-        )
+        self.check_rl(guild.id)
+        try:
+            data = await self.request(
+                'POST', f'/guilds/{guild.id}/emojis',
+                guild.id,
+                data=create_emote_body(name, image, role_ids),
+                headers={'Content-Type': 'application/json'},
+                reason=reason,
+            )
+        except RateLimitedError as exc:
+            self.guild_rls[guild.id] = exc.retry_at.timestamp()
+            raise
         return PartialEmoji(animated=data.get('animated', False), name=data.get('name'), id=data.get('id'))
 
+    async def delete(self, *, guild, emote_id, reason=None):
+        # deletes have their own bucket, so a guild being limited on creates doesn't stop them
+        await self.request('DELETE', f'/guilds/{guild.id}/emojis/{emote_id}', guild.id, reason=reason)
+
     async def __aenter__(self):
         self.http = await self.http.__aenter__()
         return self
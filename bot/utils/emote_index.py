@@ -0,0 +1,180 @@
+# © lambda#0987 <lambda@lambda.dance>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+"""per-guild indexes of emotes by ID and by case-insensitive name, sorted listings of them, and slot counts,
+and hashes of emote images
+"""
+
+import collections
+import hashlib
+
+
+class _Index:
+    def __init__(self, emotes):
+        # the guild.emojis tuple this index is up to date with
+        self.source = emotes
+        self.by_id = {}
+        # lowercased name → IDs of the emotes with that name
+        self.by_name = collections.defaultdict(list)
+        # filter predicate → emotes matching it, sorted by name
+        self.listings = {}
+        # animated → how many emotes in by_id
+        self.counts = collections.Counter()
+        # emotes we've created or deleted that the gateway hasn't told us about yet
+        self.pending_created = {}  # ID → animated
+        self.pending_deleted = {}  # ID → animated
+        for emote in emotes:
+            self.add(emote)
+
+    def add(self, emote):
+        self.by_id[emote.id] = emote
+        self.by_name[emote.name.lower()].append(emote.id)
+        self.counts[emote.animated] += 1
+
+    def remove(self, id):
+        emote = self.by_id.pop(id)
+        self.counts[emote.animated] -= 1
+        key = emote.name.lower()
+        ids = self.by_name[key]
+        ids.remove(id)
+        if not ids:
+            del self.by_name[key]
+
+    def update(self, emotes):
+        ids = set()
+        for emote in emotes:
+            ids.add(emote.id)
+            old = self.by_id.get(emote.id)
+            if old is None:
+                self.add(emote)
+            elif old.name != emote.name:
+                self.remove(emote.id)
+                self.add(emote)
+            else:
+                # discord.py makes new Emoji objects on every update, so keep the latest
+                self.by_id[emote.id] = emote
+
+        for id in self.by_id.keys() - ids:
+            self.remove(id)
+
+        self.listings.clear()
+        self.source = emotes
+
+        for id in [id for id in self.pending_created if id in self.by_id]:
+            del self.pending_created[id]
+        for id in [id for id in self.pending_deleted if id not in self.by_id]:
+            del self.pending_deleted[id]
+
+    def slot_counts(self):
+        counts = self.counts.copy()
+        for animated in self.pending_created.values():
+            counts[animated] += 1
+        for animated in self.pending_deleted.values():
+            counts[animated] -= 1
+        return counts
+
+
+class GuildEmoteIndex:
+    """Looks up a guild's emotes by ID or name, and counts its used emote slots, in O(1).
+
+    Each guild's index is built the first time it is needed and then kept current with update().
+    Sorted listings of a guild's emotes are cached until its emotes next change.
+    If the guild's emotes were replaced without us hearing about it (for example after a reconnect),
+    the index is brought up to date on the next lookup, keeping the emotes we've created or deleted
+    that the new list doesn't reflect yet.
+    """
+
+    def __init__(self):
+        # guild ID → _Index
+        self._guilds = {}
+
+    def _index(self, guild):
+        index = self._guilds.get(guild.id)
+        if index is None:
+            index = self._guilds[guild.id] = _Index(guild.emojis)
+        elif index.source is not guild.emojis:
+            index.update(guild.emojis)
+        return index
+
+    def get(self, guild, id):
+        """Return the emote in guild with the given ID, or None."""
+        return self._index(guild).by_id.get(id)
+
+    def named(self, guild, name):
+        """Return a list of the emotes in guild whose name is name, ignoring case."""
+        index = self._index(guild)
+        return [index.by_id[id] for id in index.by_name.get(name.lower(), ())]
+
+    def listing(self, guild, predicate):
+        """Return a tuple of the emotes in guild for which predicate is true, sorted by name ignoring case.
+
+        Listings are cached until the guild's emotes change, so predicate should be a long-lived function.
+        """
+        index = self._index(guild)
+        try:
+            return index.listings[predicate]
+        except KeyError:
+            emotes = sorted(filter(predicate, index.by_id.values()), key=lambda e: e.name.lower())
+            listing = index.listings[predicate] = tuple(emotes)
+            return listing
+
+    def slot_counts(self, guild):
+        """Return a Counter of how many static (False) and animated (True) emote slots are used in guild.
+
+        Emotes we've created or deleted through created() and deleted() count, even before the gateway confirms them.
+        """
+        return self._index(guild).slot_counts()
+
+    def created(self, guild, id, animated):
+        """Record that we created an emote in guild, so that it counts against the slots right away."""
+        index = self._index(guild)
+        if id not in index.by_id:
+            index.pending_created[id] = animated
+
+    def deleted(self, guild, id):
+        """Record that we deleted an emote from guild, so that its slot is free right away."""
+        index = self._index(guild)
+        emote = index.by_id.get(id)
+        if emote is not None:
+            index.pending_deleted[id] = emote.animated
+        else:
+            index.pending_created.pop(id, None)
+
+    def update(self, guild, emotes):
+        """Bring guild's index up to date with its new list of emotes. Guilds that aren't indexed are ignored."""
+        index = self._guilds.get(guild.id)
+        if index is not None:
+            index.update(emotes)
+
+    def discard(self, guild_id):
+        self._guilds.pop(guild_id, None)
+
+
+def content_hash(data: bytes) -> bytes:
+    """Return a digest of data, for finding identical images."""
+    return hashlib.sha256(data).digest()
+
+
+class EmoteHashIndex:
+    """Remembers the content_hash() of each emote image we've seen, by emote ID.
+
+    Entries never go stale, for the reason given in utils.emote.cdn_cache_key();
+    the least recently used are dropped past max_size.
+    """
+
+    def __init__(self, max_size=100_000):
+        self.max_size = max_size
+        # emote ID → digest
+        self._hashes = collections.OrderedDict()
+
+    def get(self, id):
+        digest = self._hashes.get(id)
+        if digest is not None:
+            self._hashes.move_to_end(id)
+        return digest
+
+    def put(self, id, digest):
+        self._hashes[id] = digest
+        self._hashes.move_to_end(id)
+        while len(self._hashes) > self.max_size:
+            self._hashes.popitem(last=False)
@@ -48,6 +48,7 @@ class RateLimitedError(EmoteManagerError):
         if isinstance(retry_at, float):
             # it took me about an HOUR to realize i had to pass tz because utcfromtimestamp returns a NAÏVE time obj!
             retry_at = datetime.datetime.fromtimestamp(retry_at, tz=datetime.timezone.utc)
+        self.retry_at = retry_at
         # humanize.naturaltime is annoying to work with due to timezones so we use this
         delta = humanize.naturaldelta(retry_at, when=datetime.datetime.now(tz=datetime.timezone.utc))
         super().__init__(f'Error: Discord told me to slow down! Please retry this command in {delta}.')
@@ -65,6 +66,15 @@ class FileTooBigError(EmoteManagerError):
         self.limit = limit
 
 
+class ImageTooLargeError(EmoteManagerError):
+    """The image has too many pixels to be resized"""
+    def __init__(self, width, height, limit):
+        self.width = width
+        self.height = height
+        self.limit = limit
+        super().__init__(f'The image is {width}×{height} pixels, which is more than the limit of {limit:,} pixels.')
+
+
 class InvalidFileError(EmoteManagerError):
     """The file is not a zip, tar, GIF, PNG, JPG, or WEBP file."""
     def __init__(self):
@@ -77,6 +87,22 @@ class InvalidImageError(InvalidFileError):
         super(Exception, self).__init__('The image supplied was not a GIF, PNG, JPG, or WEBP file.')
 
 
+class InvalidArchiveError(InvalidFileError, ValueError):
+    """The archive is not a zip or tar file, or it is corrupt"""
+    def __init__(self):
+        super(Exception, self).__init__('The archive supplied was not a valid zip or tar file.')
+
+
+class ArchiveBombError(EmoteManagerError):
+    """The archive decompresses to too much data, or is compressed far too well to be full of images"""
+    def __init__(self):
+        super().__init__('That archive decompresses to too much data.')
+
+
+class ECIndexUnavailableError(EmoteManagerError):
+    """The Emote Collector index hasn't been built yet"""
+
+
 class PermissionDeniedError(EmoteManagerError):
     """Raised when a user tries to modify an emote without the Manage Emojis permission"""
     def __init__(self, name):
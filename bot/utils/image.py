@@ -3,59 +3,162 @@
 
 import asyncio
 import base64
+import collections
 import contextlib
 import functools
+import hashlib
 import io
 import logging
-import signal
+import struct
 import sys
 import typing
 
-from utils import errors
+from utils import errors, metrics, tracing
+from utils.cache import ByteCache
 
 logger = logging.getLogger(__name__)
 
-try:
-    import wand.image
-except (ImportError, OSError):
-    logger.warn('Failed to import wand.image. Image manipulation functions will be unavailable.')
-else:
-    import wand.exceptions
+IMAGE_JOB_SECONDS = metrics.histogram(
+    'emote_manager_image_job_seconds', 'Time the image workers spent on each job, by command', ('command',))
+IMAGE_CACHE_LOOKUPS = metrics.counter(
+    'emote_manager_image_cache_lookups_total', 'Lookups of processed images in the cache, by result', ('result',))
+
+# wand (and so ImageMagick) is slow to import, and only the image workers use it, so it's imported by load_wand()
+wand = None
+
+
+def load_wand():
+    """Import wand the first time it's needed. Raises ImportError (or OSError) if it can't be loaded."""
+    global wand
+    if wand is None:
+        try:
+            import wand.image
+            import wand.exceptions
+        except (ImportError, OSError):
+            logger.warning('Failed to import wand.image. Image manipulation functions will be unavailable.')
+            raise
+    return wand
+
+
+MAX_EMOTE_SIZE = 256 * 2**10  # bytes
+MAX_RESIZE_RESOLUTION = 128  # pixels
+MIN_RESIZE_RESOLUTION = 32  # pixels
+# the resize search never encodes the image more than this many times
+MAX_RESIZE_ENCODES = 4
+# aim a little under the limit, since the size estimates are only approximate
+RESIZE_SAFETY_MARGIN = 0.95
+# colour depths to fall back to when a GIF is still too big at the minimum resolution
+GIF_COLOR_DEPTHS = (None, 128, 64, 32)
+# roughly one local colour table per frame, which doesn't shrink along with the resolution
+GIF_FRAME_OVERHEAD = 800  # bytes
 
 
 def resize_until_small(image_data: io.BytesIO) -> None:
-    """If the image_data is bigger than 256KB, resize it until it's not."""
+    """If the image_data is bigger than 256KiB, resize it to the largest size that is not."""
     # It's important that we only attempt to resize the image when we have to,
     # ie when it exceeds the Discord limit of 256KiB.
     # Apparently some <256KiB images become larger when we attempt to resize them,
     # so resizing sometimes does more harm than good.
-    max_resolution = 128  # pixels
     image_size = size(image_data)
-    if image_size <= 256 * 2**10:
+    if image_size <= MAX_EMOTE_SIZE:
         return
 
+    logger.debug('image size too big (%s bytes)', image_size)
+    load_wand()
     try:
         with wand.image.Image(blob=image_data) as original_image:
-            while True:
-                logger.debug('image size too big (%s bytes)', image_size)
-                logger.debug('attempting resize to at most%s*%s pixels', max_resolution, max_resolution)
-
-                with original_image.clone() as resized:
-                    resized.transform(resize=f'{max_resolution}x{max_resolution}')
-                    image_size = len(resized.make_blob())
-                    if image_size <= 256 * 2**10 or max_resolution < 32:  # don't resize past 256KiB or 32×32
-                        image_data.truncate(0)
-                        image_data.seek(0)
-                        resized.save(file=image_data)
-                        image_data.seek(0)
-                        break
-
-                max_resolution //= 2
+            resized = resize_to_fit(original_image, image_size)
     except wand.exceptions.CoderError:
         raise errors.InvalidImageError
 
+    image_data.truncate(0)
+    image_data.seek(0)
+    image_data.write(resized)
+    image_data.seek(0)
+
+
+def resize_to_fit(original_image, image_size) -> bytes:
+    """Return an encoding of original_image that is as large as possible while still fitting in MAX_EMOTE_SIZE.
+
+    Encoded size grows roughly linearly with the number of pixels, so rather than halving the resolution until
+    the image fits, we predict the right resolution from the source size and frame count, then correct the
+    prediction using the size of each encode. This usually converges in one or two encodes.
+    If a GIF does not fit even at MIN_RESIZE_RESOLUTION, its colour depth is reduced as well.
+    If nothing fits, the smallest encoding tried is returned.
+    """
+    width, height = original_image.size
+    longest_side = max(width, height)
+    upper = min(MAX_RESIZE_RESOLUTION, longest_side)
+    lower = min(MIN_RESIZE_RESOLUTION, upper)
+    is_gif = original_image.format == 'GIF'
+    color_depths = GIF_COLOR_DEPTHS if is_gif else GIF_COLOR_DEPTHS[:1]
+
+    frame_overhead = GIF_FRAME_OVERHEAD * len(original_image.sequence) if is_gif else 0
+    available = MAX_EMOTE_SIZE - frame_overhead
+    scalable = max(image_size - frame_overhead, 1)
+    if available > 0:
+        edge = _clamp(_scale_edge(longest_side, available / scalable), lower, upper)
+    else:
+        edge = lower
+
+    depth_index = 0
+    best = None  # (edge, blob) of the largest encoding that fit
+    too_big = upper + 1  # the smallest edge known not to fit at the current colour depth
+    blob = None
+
+    for _ in range(MAX_RESIZE_ENCODES):
+        color_depth = color_depths[depth_index]
+        logger.debug('attempting resize to at most %s*%s pixels (colours: %s)', edge, edge, color_depth or 'all')
+        blob = _encode_resized(original_image, edge, color_depth)
+
+        if len(blob) <= MAX_EMOTE_SIZE:
+            if best is None or edge > best[0]:
+                best = edge, blob
+
+            next_edge = min(_scale_edge(edge, MAX_EMOTE_SIZE / len(blob)), upper, too_big - 1)
+            # another encode isn't worth it for a few more pixels
+            if next_edge < edge * 1.1:
+                break
+        else:
+            too_big = edge
+            if edge <= lower:
+                if depth_index + 1 == len(color_depths):
+                    break
+                depth_index += 1
+                continue
+
+            next_edge = max(_scale_edge(edge, MAX_EMOTE_SIZE / len(blob)), lower)
+            if best is not None and next_edge <= best[0]:
+                break
+
+        edge = next_edge
+
+    return best[1] if best is not None else blob
+
+
+def _scale_edge(edge, size_ratio):
+    """scale the length of a side so that the number of pixels changes by roughly size_ratio."""
+    return int(edge * size_ratio ** 0.5 * RESIZE_SAFETY_MARGIN)
+
+
+def _clamp(x, lower, upper):
+    return max(lower, min(x, upper))
+
+
+def _encode_resized(original_image, edge, color_depth=None) -> bytes:
+    with original_image.clone() as resized:
+        resized.transform(resize=f'{edge}x{edge}')
+        if color_depth is not None:
+            # quantize() only reduces the current frame, so step through each of them
+            for index in range(resized.iterator_length()):
+                resized.iterator_set(index)
+                resized.quantize(color_depth, 'undefined', 0, False, False)
+            resized.iterator_reset()
+        return resized.make_blob()
+
 
 def convert_to_gif(image_data: io.BytesIO) -> None:
+    load_wand()
     try:
         with wand.image.Image(blob=image_data) as orig, orig.convert('gif') as converted:
             # discord tries to stop us from abusing animated gif slots by detecting single frame gifs
@@ -71,6 +174,7 @@ def convert_to_gif(image_data: io.BytesIO) -> None:
         raise errors.InvalidImageError
 
 
+@tracing.traced('mime_type_for_image')
 def mime_type_for_image(data):
     if data.startswith(b'\x89PNG\r\n\x1a\n'):
         return 'image/png'
@@ -91,14 +195,18 @@ def image_to_base64_url(data):
 
 
 def main() -> typing.NoReturn:
-    """resize or convert an image from stdin and write the resized or converted version to stdout."""
+    """resize or convert an image from stdin and write the resized or converted version to stdout.
+
+    If the command is "worker", process jobs from stdin until it is closed instead. See ImageWorker for the protocol.
+    """
     import sys
 
-    if sys.argv[1] == 'resize':
-        f = resize_until_small
-    elif sys.argv[1] == 'convert':
-        f = convert_to_gif
-    else:
+    if sys.argv[1] == 'worker':
+        worker_main()
+
+    try:
+        f = COMMANDS[sys.argv[1]]
+    except KeyError:
         sys.exit(1)
 
     data = io.BytesIO(sys.stdin.buffer.read())
@@ -120,26 +228,278 @@ def main() -> typing.NoReturn:
     sys.exit(0)
 
 
-async def process_image_in_subprocess(command_name, image_data: bytes):
-    proc = await asyncio.create_subprocess_exec(
-        sys.executable, '-m', __name__, command_name,
+def worker_main() -> typing.NoReturn:
+    """process length-prefixed jobs from stdin, writing length-prefixed results to stdout, until stdin is closed."""
+    stdin = sys.stdin.buffer
+    stdout = sys.stdout.buffer
+    # pay for the import now rather than during the first job
+    load_wand()
 
-        stdin=asyncio.subprocess.PIPE,
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE)
-
-    try:
-        image_data, err = await asyncio.wait_for(proc.communicate(image_data), timeout=float('inf'))
-    except asyncio.TimeoutError:
-        proc.send_signal(signal.SIGINT)
-        raise errors.ImageResizeTimeoutError if command_name == 'resize' else errors.ImageConversionTimeoutError
-    else:
-        if proc.returncode == 2:
+    while True:
+        header = stdin.read(JOB_HEADER.size)
+        if len(header) < JOB_HEADER.size:
+            # the pool closed our stdin, either to recycle us or because it's shutting down
+            sys.exit(0)
+
+        command_index, length = JOB_HEADER.unpack(header)
+        data = io.BytesIO(stdin.read(length))
+        try:
+            COMMANDS[COMMAND_NAMES[command_index]](data)
+        except errors.InvalidImageError:
+            stdout.write(JOB_HEADER.pack(STATUS_INVALID_IMAGE, 0))
+        else:
+            result = data.getvalue()
+            stdout.write(JOB_HEADER.pack(STATUS_OK, len(result)))
+            stdout.write(result)
+        stdout.flush()
+
+
+COMMANDS = {
+    'resize': resize_until_small,
+    'convert': convert_to_gif,
+}
+COMMAND_NAMES = tuple(COMMANDS)
+
+# (command index or status, payload length)
+JOB_HEADER = struct.Struct('>BI')
+STATUS_OK = 0
+# matches the exit code used by main() for the same condition
+STATUS_INVALID_IMAGE = 2
+
+
+class ImageWorker:
+    """A long-lived `python -m utils.image worker` process.
+
+    Each job is sent as a JOB_HEADER of (command index, length) followed by the image.
+    The worker replies with a JOB_HEADER of (status, length) followed by the processed image.
+    Closing stdin makes the worker exit cleanly.
+    """
+
+    # seconds to wait for a worker to exit after closing its stdin, before killing it
+    EXIT_TIMEOUT = 5.0
+
+    def __init__(self, proc):
+        self.proc = proc
+        self.jobs = 0
+        self.broken = False
+        # keep the tail of stderr so that crashes can be reported, without letting the pipe fill up
+        self.stderr = collections.deque(maxlen=50)
+        self._stderr_task = asyncio.ensure_future(self._drain_stderr())
+
+    @classmethod
+    async def spawn(cls):
+        proc = await asyncio.create_subprocess_exec(
+            sys.executable, '-m', __name__, 'worker',
+
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE)
+        return cls(proc)
+
+    @property
+    def alive(self):
+        return not self.broken and self.proc.returncode is None
+
+    async def _drain_stderr(self):
+        async for line in self.proc.stderr:
+            self.stderr.append(line)
+
+    async def run(self, command_name, image_data: bytes) -> bytes:
+        self.jobs += 1
+        self.proc.stdin.write(JOB_HEADER.pack(COMMAND_NAMES.index(command_name), len(image_data)))
+        self.proc.stdin.write(image_data)
+        await self.proc.stdin.drain()
+
+        status, length = JOB_HEADER.unpack(await self.proc.stdout.readexactly(JOB_HEADER.size))
+        if status == STATUS_INVALID_IMAGE:
             raise errors.InvalidImageError
-        if proc.returncode != 0:
-            raise RuntimeError(err.decode('utf-8') + f'Return code: {proc.returncode}')
+        return await self.proc.stdout.readexactly(length)
+
+    async def crash_report(self):
+        """wait for a worker that has died mid-job to exit and describe why."""
+        self.broken = True
+        returncode = await self.proc.wait()
+        await self._stderr_task
+        return b''.join(self.stderr).decode('utf-8', 'replace') + f'Return code: {returncode}'
+
+    def kill(self):
+        # SIGKILL, because python can't handle SIGINT while ImageMagick is stuck in C code
+        self.broken = True
+        with contextlib.suppress(ProcessLookupError):
+            self.proc.kill()
+
+    async def close(self):
+        """let the worker exit on its own once it notices that stdin was closed, or kill it if it takes too long."""
+        if self.proc.returncode is None:
+            self.proc.stdin.close()
+            try:
+                await asyncio.wait_for(self.proc.wait(), self.EXIT_TIMEOUT)
+            except asyncio.TimeoutError:
+                self.kill()
+                await self.proc.wait()
+        await self._stderr_task
+
+
+class ImageWorkerPool:
+    """A pool of pre-warmed image worker processes.
+
+    Each worker is a separate interpreter, so a crash or a hung ImageMagick only takes down that worker,
+    which is then replaced. Workers are recycled after max_jobs jobs to bound any memory they leak.
+    """
+
+    def __init__(self, *, size=2, max_jobs=100, timeout=float('inf')):
+        self.size = size
+        self.max_jobs = max_jobs
+        self.timeout = timeout
+
+        self._started = None
+        self._idle = None
+        self._waiting = 0
+        self._workers = set()
+        self._closed = False
+
+    @property
+    def queue_depth(self):
+        """The number of jobs waiting for a free worker."""
+        return self._waiting
+
+    def stats(self):
+        return {
+            'size': self.size,
+            'workers': len(self._workers),
+            'idle': self._idle.qsize() if self._idle is not None else 0,
+            'queue_depth': self.queue_depth,
+        }
+
+    async def start(self):
+        """spawn the workers ahead of time so that the first jobs don't pay for interpreter startup."""
+        if self._started is None:
+            self._started = asyncio.ensure_future(self._start())
+        await asyncio.shield(self._started)
+
+    async def _start(self):
+        # each item is either a live worker or None, meaning that a worker should be spawned in that slot
+        self._idle = asyncio.Queue()
+        workers = await asyncio.gather(*(self._spawn() for _ in range(self.size)), return_exceptions=True)
+        for worker in workers:
+            if isinstance(worker, BaseException):
+                logger.error('failed to spawn an image worker', exc_info=worker)
+                worker = None
+            self._idle.put_nowait(worker)
+
+    async def close(self):
+        self._closed = True
+        await asyncio.gather(*(worker.close() for worker in self._workers), return_exceptions=True)
+        self._workers.clear()
+
+    async def _spawn(self):
+        worker = await ImageWorker.spawn()
+        self._workers.add(worker)
+        return worker
+
+    async def _acquire(self):
+        await self.start()
+
+        self._waiting += 1
+        if self._idle.empty():
+            logger.debug('all image workers are busy (queue depth: %s)', self._waiting)
+        try:
+            worker = await self._idle.get()
+        finally:
+            self._waiting -= 1
+
+        if worker is None or not worker.alive:
+            self._workers.discard(worker)
+            try:
+                worker = await self._spawn()
+            except BaseException:
+                self._idle.put_nowait(None)
+                raise
+
+        return worker
+
+    def _release(self, worker):
+        if self._closed:
+            asyncio.ensure_future(worker.close())
+        elif worker.alive and worker.jobs < self.max_jobs:
+            self._idle.put_nowait(worker)
+        else:
+            self._replace(worker)
+
+    def _replace(self, worker):
+        """retire a worker and spawn its replacement in the background."""
+        async def replace():
+            self._workers.discard(worker)
+
+            # before waiting for the old worker, which may be stuck
+            try:
+                new_worker = await self._spawn()
+            except Exception:
+                logger.exception('failed to spawn an image worker')
+                new_worker = None
+
+            if self._closed and new_worker is not None:
+                await new_worker.close()
+            else:
+                self._idle.put_nowait(new_worker)
+
+            await worker.close()
+
+        asyncio.ensure_future(replace())
+
+    async def process(self, command_name, image_data: bytes) -> bytes:
+        worker = await self._acquire()
+        try:
+            with IMAGE_JOB_SECONDS.labels(command_name).time():
+                return await asyncio.wait_for(worker.run(command_name, image_data), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            worker.kill()
+            raise errors.ImageResizeTimeoutError if command_name == 'resize' else errors.ImageConversionTimeoutError
+        except (asyncio.IncompleteReadError, BrokenPipeError, ConnectionResetError):
+            raise RuntimeError(await worker.crash_report())
+        except asyncio.CancelledError:
+            # the worker may be halfway through a reply that nobody will read
+            worker.kill()
+            raise
+        finally:
+            self._release(worker)
+
+
+worker_pool = ImageWorkerPool()
+
+
+def configure_worker_pool(**kwargs):
+    """Replace the default worker pool. Must be called before any images are processed."""
+    global worker_pool
+    worker_pool = ImageWorkerPool(**kwargs)
+    return worker_pool
+
+
+# disabled until configured
+image_cache = ByteCache(memory_limit=0)
+
+
+def configure_image_cache(**kwargs):
+    """Replace the cache of processed images. kwargs are passed to ByteCache."""
+    global image_cache
+    image_cache = ByteCache(**kwargs)
+    return image_cache
+
 
-    return image_data
+async def process_image_in_subprocess(command_name, image_data: bytes):
+    # the same images get uploaded to many servers, so skip the work if we've done it before
+    with tracing.span(f'image {command_name}'):
+        key = f'{command_name}-{hashlib.sha256(image_data).hexdigest()}'
+        processed = await image_cache.get(key)
+        if processed is not None:
+            IMAGE_CACHE_LOOKUPS.labels('hit').inc()
+            tracing.annotate(cached=True)
+            return processed
+        IMAGE_CACHE_LOOKUPS.labels('miss').inc()
+
+        processed = await worker_pool.process(command_name, image_data)
+        await image_cache.put(key, processed)
+        return processed
 
 resize_in_subprocess = functools.partial(process_image_in_subprocess, 'resize')
 convert_to_gif_in_subprocess = functools.partial(process_image_in_subprocess, 'convert')
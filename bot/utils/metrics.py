@@ -0,0 +1,238 @@
+# © lambda#0987 <lambda@lambda.dance>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+"""in-process counters, gauges and histograms, which can be served in the Prometheus text format
+
+metrics are cheap to update (a dict lookup and an addition or two), so they are always on.
+the HTTP endpoint is only started if asked for.
+"""
+
+import bisect
+import contextlib
+import math
+import time
+from typing import Callable, Dict, Optional, Sequence, Tuple
+
+# seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# bytes: 64KiB to 128MiB
+SIZE_BUCKETS = tuple(2**n for n in range(16, 28))
+
+
+def _escape(value, *, quotes=True):
+    value = str(value).replace('\\', r'\\').replace('\n', r'\n')
+    return value.replace('"', r'\"') if quotes else value
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        # label values → child
+        self._children: Dict[Tuple, object] = {}
+        if not self.labelnames:
+            # so that it's exported even before it's first updated
+            self.labels()
+
+    def labels(self, *values):
+        """Return the child metric for these label values, creating it if necessary."""
+        if len(values) != len(self.labelnames):
+            raise ValueError(f'{self.name} takes {len(self.labelnames)} label values, not {len(values)}')
+        try:
+            return self._children[values]
+        except KeyError:
+            child = self._children[values] = self._new_child()
+            return child
+
+    def _unlabelled(self):
+        return self.labels()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def render(self):
+        yield f'# HELP {self.name} {_escape(self.documentation, quotes=False)}'
+        yield f'# TYPE {self.name} {self.type}'
+        for values, child in self._children.items():
+            yield from self._render_child(values, child)
+
+    def _render_child(self, values, child):
+        yield f'{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.value)}'
+
+
+class _Value:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self._unlabelled().inc(amount)
+
+
+class Gauge(_Metric):
+    """A value that can go up and down. If function is given, it is called for the value whenever rendered."""
+
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), *, function: Optional[Callable[[], float]] = None):
+        self.function = function
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _Value()
+
+    def set(self, value):
+        self._unlabelled().set(value)
+
+    def inc(self, amount=1):
+        self._unlabelled().inc(amount)
+
+    def render(self):
+        if self.function is not None:
+            self.set(self.function())
+        return super().render()
+
+
+class _HistogramValue:
+    __slots__ = ('bounds', 'buckets', 'sum', 'count')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # not cumulative: buckets[i] counts observations in (bounds[i-1], bounds[i]]. the last one is +Inf
+        self.buckets = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    @contextlib.contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), *, buckets=DEFAULT_BUCKETS):
+        self.bounds = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramValue(self.bounds)
+
+    def observe(self, value):
+        self._unlabelled().observe(value)
+
+    def time(self):
+        """Context manager that observes how many seconds its block took."""
+        return self._unlabelled().time()
+
+    def _render_child(self, values, child):
+        cumulative = 0
+        for bound, count in zip((*self.bounds, math.inf), child.buckets):
+            cumulative += count
+            labels = _format_labels(self.labelnames, values, (('le', _format_value(float(bound))),))
+            yield f'{self.name}_bucket{labels} {cumulative}'
+        labels = _format_labels(self.labelnames, values)
+        yield f'{self.name}_sum{labels} {_format_value(child.sum)}'
+        yield f'{self.name}_count{labels} {child.count}'
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric):
+        """Add metric to the registry and return it.
+
+        If a metric of the same name and type is already registered, that one is returned instead,
+        so that modules which define metrics can be reloaded.
+        """
+        existing = self._metrics.get(metric.name)
+        if existing is not None:
+            if type(existing) is not type(metric):
+                raise ValueError(f'{metric.name} is already registered as a {existing.type}')
+            if isinstance(metric, Gauge):
+                # the new function probably refers to the new module
+                existing.function = metric.function
+            return existing
+
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        """Return every metric in the Prometheus text exposition format."""
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        lines.append('')
+        return '\n'.join(lines)
+
+
+REGISTRY = Registry()
+
+
+def counter(name, documentation, labelnames=()) -> Counter:
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name, documentation, labelnames=(), *, function=None) -> Gauge:
+    return REGISTRY.register(Gauge(name, documentation, labelnames, function=function))
+
+
+def histogram(name, documentation, labelnames=(), *, buckets=DEFAULT_BUCKETS) -> Histogram:
+    return REGISTRY.register(Histogram(name, documentation, labelnames, buckets=buckets))
+
+
+async def start_server(host, port, *, registry=REGISTRY):
+    """Serve registry at http://host:port/metrics. Returns an aiohttp.web.AppRunner; call its cleanup() to stop."""
+    from aiohttp import web
+
+    async def handle(request):
+        return web.Response(text=registry.render(), content_type='text/plain', charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -0,0 +1,142 @@
+# © lambda#0987 <lambda@lambda.dance>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+"""coalesces the output of commands that work on many items into as few messages as possible"""
+
+import asyncio
+import contextlib
+
+import discord
+
+MESSAGE_LIMIT = 2000
+
+
+def pack(lines, limit=MESSAGE_LIMIT):
+    """Join lines into as few messages as possible, each at most limit characters long.
+
+    Lines longer than limit are split.
+    """
+    messages = []
+    current = []
+    size = 0
+    for line in lines:
+        while len(line) > limit:
+            # give the long line a message (or more) of its own
+            if current:
+                messages.append('\n'.join(current))
+                current, size = [], 0
+            messages.append(line[:limit])
+            line = line[limit:]
+
+        # + 1 for the newline
+        if current and size + 1 + len(line) > limit:
+            messages.append('\n'.join(current))
+            current, size = [], 0
+
+        size += len(line) + bool(current)
+        current.append(line)
+
+    if current:
+        messages.append('\n'.join(current))
+    return messages
+
+
+class OutputSink:
+    """Buffers lines of output for a channel, sending them every interval seconds in as few messages as possible.
+
+    Optionally, a progress message is sent first and edited on the same interval whenever progress is changed.
+    Use it as an async context manager; everything left over is sent when the block exits.
+
+        async with OutputSink(context, progress='Working…') as output:
+            for item in items:
+                output.add(await do(item))
+                output.progress = f'{i} of {len(items)} done.'
+            output.progress = 'Done.'
+    """
+
+    def __init__(self, destination, *, progress=None, interval=2.0, limit=MESSAGE_LIMIT):
+        self.destination = destination
+        self.interval = interval
+        self.limit = limit
+
+        self.progress = progress
+        self._progress_message = None
+        self._shown_progress = None
+
+        self._lines = []
+        self._size = 0
+        self._lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._closing = False
+        self._task = None
+
+        self.messages_sent = 0
+
+    def add(self, line):
+        """Queue line to be sent. If more than a whole message's worth of lines is waiting, one is sent right away."""
+        self._queue(str(line))
+        # the newline after the last line isn't sent, so limit + 1 exactly fills one message
+        if self._size > self.limit + 1:
+            self._wakeup.set()
+
+    def _queue(self, line):
+        self._lines.append(line)
+        self._size += len(line) + 1
+
+    async def __aenter__(self):
+        if self.progress is not None:
+            await self._update_progress()
+        self._task = asyncio.ensure_future(self._run())
+        return self
+
+    async def __aexit__(self, *excinfo):
+        # let the task finish what it's sending rather than cancelling it, so that nothing is lost
+        self._closing = True
+        self._wakeup.set()
+        await self._task
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                await self.flush()
+                continue
+
+            self._wakeup.clear()
+            if self._closing:
+                await self.flush()
+                return
+            # woken early because a message filled up; the rest can wait for more lines
+            await self.flush(full_only=True)
+
+    async def flush(self, *, full_only=False):
+        """Send queued lines and update the progress message.
+
+        If full_only, the last, partly filled message is held back.
+        """
+        async with self._lock:
+            await self._update_progress()
+
+            messages = pack(self._lines, self.limit)
+            self._lines, self._size = [], 0
+            if full_only and messages:
+                # not through add(), which could wake us up again for the same message
+                self._queue(messages.pop())
+
+            for message in messages:
+                await self.destination.send(message)
+                self.messages_sent += 1
+
+    async def _update_progress(self):
+        if self.progress is None or self.progress == self._shown_progress:
+            return
+
+        content = self.progress
+        if self._progress_message is None:
+            self._progress_message = await self.destination.send(content)
+            self.messages_sent += 1
+        else:
+            with contextlib.suppress(discord.HTTPException):
+                await self._progress_message.edit(content=content)
+        self._shown_progress = content
@@ -2,6 +2,7 @@
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
 import asyncio
+import collections.abc
 import contextlib
 import typing
 
@@ -23,7 +24,8 @@ class Paginator:
         text_message=None
     ):
 
-        self.pages = list(pages)
+        # sequences may render their pages lazily, so leave them be
+        self.pages = pages if isinstance(pages, collections.abc.Sequence) else list(pages)
         self.timeout = timeout
         self.author = ctx.author
         self.target = ctx.channel
@@ -32,7 +34,6 @@ class Paginator:
         self.text_message = text_message
 
         self._stopped = None  # we use this later
-        self._embed = None
         self._message = None
         self._client = ctx.bot
 
@@ -46,6 +47,9 @@ class Paginator:
         }
 
         self._page = None
+        self._shown_page = None
+        # page number → embed
+        self._embeds = {}
 
     def react_check(self, reaction: discord.RawReactionActionEvent):
         if reaction.user_id != self.author.id:
@@ -60,7 +64,6 @@ class Paginator:
     async def begin(self):
         """Starts pagination"""
         self._stopped = False
-        self._embed = discord.Embed()
         await self.first_page()
         for button in self.navigation:
             await self._message.add_reaction(button)
@@ -102,11 +105,22 @@ class Paginator:
         except discord.HTTPException:
             pass
 
+    def render_page(self, page):
+        try:
+            return self._embeds[page]
+        except KeyError:
+            pass
+
+        embed = self._embeds[page] = discord.Embed(description=self.pages[page])
+        embed.set_footer(text=self.footer.format(page + 1, len(self.pages)))
+        return embed
+
     async def format_page(self):
-        self._embed.description = self.pages[self._page]
-        self._embed.set_footer(text=self.footer.format(self._page + 1, len(self.pages)))
+        if self._message and self._page == self._shown_page:
+            # e.g. "next page" when there's only one page
+            return
 
-        kwargs = {'embed': self._embed}
+        kwargs = {'embed': self.render_page(self._page)}
         if self.text_message:
             kwargs['content'] = self.text_message
 
@@ -114,6 +128,7 @@ class Paginator:
             await self._message.edit(**kwargs)
         else:
             self._message = await self.target.send(**kwargs)
+        self._shown_page = self._page
 
     async def first_page(self):
         self._page = 0
@@ -136,23 +151,39 @@ class Paginator:
         await self.format_page()
 
 
+class _ListPages(collections.abc.Sequence):
+    """The pages of a numbered list, each rendered the first time it is needed."""
+
+    def __init__(self, items: typing.Sequence, per_page, format_item):
+        self.items = items
+        self.per_page = per_page
+        self.format_item = format_item
+        # page number → text
+        self._rendered = {}
+
+    def __len__(self):
+        # an empty list still gets one (empty) page
+        return max(1, -(-len(self.items) // self.per_page))
+
+    def __getitem__(self, page):
+        try:
+            return self._rendered[page]
+        except KeyError:
+            pass
+        if not 0 <= page < len(self):
+            raise IndexError(page)
+
+        start = page * self.per_page
+        text = self._rendered[page] = '\n'.join(
+            '{}. {}'.format(i, self.format_item(item))
+            for i, item in enumerate(self.items[start:start + self.per_page], start + 1))
+        return text
+
+
 class ListPaginator(Paginator):
-    def __init__(self, ctx, _list: list, per_page=10, **kwargs):
-        pages = []
-        page = ''
-        c = 0
-        length_of_list = len(_list)
-        for i in _list:
-            if c > length_of_list:
-                break
-            if c % per_page == 0 and page:
-                pages.append(page.strip())
-                page = ''
-            page += '{}. {}\n'.format(c + 1, i)
-
-            c += 1
-        pages.append(page.strip())
+    def __init__(self, ctx, _list: typing.Sequence, per_page=10, *, format_item=str, **kwargs):
+        """Paginate a numbered list. Each entry is formatted with format_item when its page is first shown."""
         # shut up, IDEA
         # noinspection PyArgumentList
-        super().__init__(ctx, pages, **kwargs)
-        self.footer += ' ({} entries)'.format(length_of_list)
+        super().__init__(ctx, _ListPages(_list, per_page, format_item), **kwargs)
+        self.footer += ' ({} entries)'.format(len(_list))
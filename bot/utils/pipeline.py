@@ -0,0 +1,83 @@
+# © lambda#0987 <lambda@lambda.dance>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+"""run items through a series of concurrent stages connected by bounded queues"""
+
+import asyncio
+import contextlib
+from typing import AsyncIterable, Awaitable, Callable, Iterable, Tuple, Union
+
+Stage = Tuple[Callable[[object], Awaitable[object]], int]
+
+_DONE = object()
+
+
+async def run(source: Union[AsyncIterable, Iterable], *stages: Stage, buffer_size=4):
+    """
+    feed each item from source (an iterable or async iterable) through stages, yielding the results of the last stage.
+
+    each stage is a tuple of (coroutine function, concurrency): that many copies of the stage run at once,
+    so a slow stage does not hold up the items behind it in earlier stages.
+    at most buffer_size items wait between any two stages.
+    if a stage returns None, the item is dropped.
+    items may be reordered by stages whose concurrency is greater than 1.
+
+    if any stage raises, the remaining stages are cancelled and the exception is propagated.
+    """
+    queues = [asyncio.Queue(maxsize=buffer_size) for _ in range(len(stages) + 1)]
+
+    async def feed():
+        if hasattr(source, '__aiter__'):
+            async for item in source:
+                await queues[0].put(item)
+        else:
+            for item in source:
+                await queues[0].put(item)
+        await queues[0].put(_DONE)
+
+    async def work(func, in_queue, out_queue, remaining):
+        while True:
+            item = await in_queue.get()
+            if item is _DONE:
+                # let the other workers in this stage see it too
+                await in_queue.put(_DONE)
+                remaining[0] -= 1
+                if not remaining[0]:
+                    await out_queue.put(_DONE)
+                return
+
+            result = await func(item)
+            if result is not None:
+                await out_queue.put(result)
+
+    tasks = [asyncio.ensure_future(feed())]
+    for i, (func, concurrency) in enumerate(stages):
+        remaining = [concurrency]
+        tasks.extend(
+            asyncio.ensure_future(work(func, queues[i], queues[i + 1], remaining))
+            for _ in range(concurrency))
+
+    results = queues[-1]
+    try:
+        while True:
+            getter = asyncio.ensure_future(results.get())
+            try:
+                while not getter.done():
+                    await asyncio.wait([getter, *tasks], return_when=asyncio.FIRST_COMPLETED)
+                    for task in tasks:
+                        if task.done() and not task.cancelled() and task.exception() is not None:
+                            raise task.exception()
+                    tasks = [task for task in tasks if not task.done()]
+            finally:
+                getter.cancel()
+
+            item = getter.result()
+            if item is _DONE:
+                return
+            yield item
+    finally:
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            with contextlib.suppress(asyncio.CancelledError, Exception):
+                await task
@@ -0,0 +1,144 @@
+# © lambda#0987 <lambda@lambda.dance>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+"""proactive tracking of Discord's rate limit buckets"""
+
+import asyncio
+import re
+import time
+from typing import Dict, Hashable, Optional, Tuple
+
+from utils import metrics
+from utils.errors import RateLimitedError
+
+# (HTTP method, path with IDs replaced)
+Route = Tuple[str, str]
+
+RE_SNOWFLAKE = re.compile(r'\d{17,}')
+
+RATE_LIMIT_WAITS = metrics.counter(
+    'emote_manager_rate_limit_waits_total', 'Requests that waited for a rate limit bucket to reset')
+RATE_LIMIT_WAIT_SECONDS = metrics.counter(
+    'emote_manager_rate_limit_wait_seconds_total', 'Time spent waiting for rate limit buckets to reset')
+RATE_LIMITED = metrics.counter(
+    'emote_manager_rate_limited_total', '429 responses from Discord, by scope (bucket or global)', ('scope',))
+
+
+def route_for(method, path) -> Route:
+    """Return the route that a request belongs to. The major parameter is tracked separately."""
+    return method, RE_SNOWFLAKE.sub(':id', path)
+
+
+class Bucket:
+    def __init__(self):
+        self.limit: Optional[int] = None
+        # None means that we haven't heard from Discord about this bucket yet, so don't hold anything back
+        self.remaining: Optional[int] = None
+        self.reset_at = 0.0  # event loop time
+        # the length of the bucket's window, used to guess when it will reset next until Discord tells us
+        self.reset_after = 0.0
+        # requests queue up here in order while the bucket is empty
+        self.lock = asyncio.Lock()
+
+    def delay(self, now):
+        """how long until a request may be made in this bucket"""
+        if now >= self.reset_at:
+            self.remaining = self.limit
+            self.reset_at = now + self.reset_after
+            return 0.0
+        if self.remaining is None or self.remaining > 0:
+            return 0.0
+        return self.reset_at - now
+
+
+class RateLimiter:
+    """Tracks Discord's rate limit buckets from response headers, so that requests wait before they would be limited.
+
+    Routes are mapped to buckets using the X-RateLimit-Bucket header, and each bucket is tracked separately for
+    each major parameter (for us, always the guild ID). The global rate limit is honored too.
+    Waits of max_wait seconds or more are not worth sleeping through; RateLimitedError is raised instead.
+    """
+
+    def __init__(self, *, max_wait=10.0):
+        self.max_wait = max_wait
+        # route → bucket hash given by Discord
+        self._bucket_hashes: Dict[Route, str] = {}
+        # (bucket hash, or route if unknown; major parameter) → Bucket
+        self._buckets: Dict[Tuple[Hashable, Hashable], Bucket] = {}
+        self._global_reset_at = 0.0
+
+        self.waits = 0
+        self.wait_seconds = 0.0
+
+    def _bucket(self, route, major):
+        key = self._bucket_hashes.get(route, route), major
+        try:
+            return self._buckets[key]
+        except KeyError:
+            bucket = self._buckets[key] = Bucket()
+            return bucket
+
+    def delay(self, route, major):
+        """Return how many seconds a request to route would have to wait right now."""
+        now = asyncio.get_event_loop().time()
+        return max(self._global_reset_at - now, self._bucket(route, major).delay(now), 0.0)
+
+    def check(self, route, major):
+        """Raise RateLimitedError if a request to route would have to wait at least max_wait seconds."""
+        delay = self.delay(route, major)
+        if delay >= self.max_wait:
+            raise RateLimitedError(time.time() + delay)
+
+    async def acquire(self, route, major):
+        """Wait until a request to route may be made, and reserve room for it in its bucket."""
+        loop = asyncio.get_event_loop()
+        bucket = self._bucket(route, major)
+        async with bucket.lock:
+            while True:
+                now = loop.time()
+                delay = max(self._global_reset_at - now, bucket.delay(now), 0.0)
+                if not delay:
+                    break
+                if delay >= self.max_wait:
+                    raise RateLimitedError(time.time() + delay)
+
+                self.waits += 1
+                self.wait_seconds += delay
+                RATE_LIMIT_WAITS.inc()
+                RATE_LIMIT_WAIT_SECONDS.inc(delay)
+                await asyncio.sleep(delay)
+
+            if bucket.remaining is not None:
+                bucket.remaining -= 1
+
+    def update(self, route, major, headers):
+        """Update our view of route's bucket from the headers of a response."""
+        bucket_hash = headers.get('X-RateLimit-Bucket')
+        if bucket_hash is not None and self._bucket_hashes.get(route) != bucket_hash:
+            self._bucket_hashes[route] = bucket_hash
+            # carry over anything we learned before we knew the bucket's name
+            old = self._buckets.pop((route, major), None)
+            if old is not None:
+                self._buckets.setdefault((bucket_hash, major), old)
+
+        bucket = self._bucket(route, major)
+        now = asyncio.get_event_loop().time()
+        try:
+            bucket.limit = int(headers['X-RateLimit-Limit'])
+            bucket.remaining = int(headers['X-RateLimit-Remaining'])
+            bucket.reset_after = float(headers['X-RateLimit-Reset-After'])
+            bucket.reset_at = now + bucket.reset_after
+        except (KeyError, ValueError):
+            pass
+
+    def limited(self, route, major, retry_after, *, is_global=False):
+        """Record that a request to route got a 429 telling us to wait retry_after seconds."""
+        reset_at = asyncio.get_event_loop().time() + retry_after
+        RATE_LIMITED.labels('global' if is_global else 'bucket').inc()
+        if is_global:
+            self._global_reset_at = max(self._global_reset_at, reset_at)
+            return
+
+        bucket = self._bucket(route, major)
+        bucket.remaining = 0
+        bucket.reset_at = max(bucket.reset_at, reset_at)
@@ -0,0 +1,138 @@
+# © lambda#0987 <lambda@lambda.dance>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+"""limits how many HTTP downloads run at once, sharing the capacity fairly between servers"""
+
+import asyncio
+import collections
+import contextlib
+import urllib.parse
+
+from utils import metrics
+
+QUEUE_WAIT_SECONDS = metrics.histogram(
+    'emote_manager_download_queue_wait_seconds', 'Time downloads spent waiting for a slot')
+TRANSFER_SECONDS = metrics.histogram(
+    'emote_manager_download_transfer_seconds', 'Time downloads held their slot for')
+
+_Waiter = collections.namedtuple('_Waiter', 'host future')
+
+
+class DownloadScheduler:
+    """Hands out download slots, subject to a global, a per host and a per guild cap on downloads in flight.
+
+    Waiting downloads are queued per guild, and the guilds are served round robin,
+    so that one server exporting hundreds of emotes cannot starve everyone else.
+    """
+
+    def __init__(self, *, max_in_flight=16, max_per_host=8, max_per_guild=4):
+        self.max_in_flight = max_in_flight
+        self.max_per_host = max_per_host
+        self.max_per_guild = max_per_guild
+
+        self._in_flight = 0
+        self._hosts = collections.Counter()
+        self._guilds = collections.Counter()
+        # guild ID → waiters, in the order the guilds will next be served
+        self._queues = collections.OrderedDict()
+
+        self.downloads = 0
+
+    @property
+    def queue_depth(self):
+        return sum(map(len, self._queues.values()))
+
+    def stats(self):
+        return {
+            'in_flight': self._in_flight,
+            'queue_depth': self.queue_depth,
+            'downloads': self.downloads,
+        }
+
+    @contextlib.asynccontextmanager
+    async def slot(self, url, guild_id=None):
+        """Wait until a download from url on behalf of guild_id may start, and hold the slot until exit."""
+        loop = asyncio.get_event_loop()
+        host = urllib.parse.urlsplit(url).hostname
+
+        queued_at = loop.time()
+        await self._acquire(host, guild_id)
+        started_at = loop.time()
+        try:
+            yield
+        finally:
+            self._release(host, guild_id)
+            self.downloads += 1
+            QUEUE_WAIT_SECONDS.observe(started_at - queued_at)
+            TRANSFER_SECONDS.observe(loop.time() - started_at)
+
+    async def _acquire(self, host, guild_id):
+        waiter = _Waiter(host, asyncio.get_event_loop().create_future())
+        self._queues.setdefault(guild_id, collections.deque()).append(waiter)
+        self._dispatch()
+
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # we were given a slot just as we were cancelled, so give it back
+                self._release(host, guild_id)
+            else:
+                self._remove(guild_id, waiter)
+            raise
+
+    def _remove(self, guild_id, waiter):
+        queue = self._queues.get(guild_id)
+        if queue is None:
+            return
+        with contextlib.suppress(ValueError):
+            queue.remove(waiter)
+        if not queue:
+            del self._queues[guild_id]
+
+    def _release(self, host, guild_id):
+        self._in_flight -= 1
+        self._hosts[host] -= 1
+        if not self._hosts[host]:
+            del self._hosts[host]
+        self._guilds[guild_id] -= 1
+        if not self._guilds[guild_id]:
+            del self._guilds[guild_id]
+
+        self._dispatch()
+
+    def _dispatch(self):
+        """start as many waiting downloads as the caps allow, one guild at a time."""
+        progress = True
+        while progress and self._in_flight < self.max_in_flight:
+            progress = False
+            for guild_id in list(self._queues):
+                if self._in_flight >= self.max_in_flight:
+                    return
+                if self._guilds[guild_id] >= self.max_per_guild:
+                    continue
+
+                queue = self._queues[guild_id]
+                # downloads cancelled while they waited haven't removed themselves yet, and must not be charged a slot
+                for cancelled in [w for w in queue if w.future.done()]:
+                    queue.remove(cancelled)
+                if not queue:
+                    del self._queues[guild_id]
+                    continue
+
+                waiter = next((w for w in queue if self._hosts[w.host] < self.max_per_host), None)
+                if waiter is None:
+                    continue
+
+                queue.remove(waiter)
+                if queue:
+                    # go to the back of the line
+                    self._queues.move_to_end(guild_id)
+                else:
+                    del self._queues[guild_id]
+
+                self._in_flight += 1
+                self._hosts[waiter.host] += 1
+                self._guilds[guild_id] += 1
+                waiter.future.set_result(None)
+                progress = True
@@ -0,0 +1,113 @@
+# © lambda#0987 <lambda@lambda.dance>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+"""identifies images, and reads their dimensions, from just the first few bytes of the file
+
+unlike utils.image, this needs nothing but the standard library, so it's cheap to import.
+"""
+
+import collections
+import struct
+from typing import Optional
+
+# enough to get past the EXIF data that usually comes before the dimensions in a JPEG
+HEAD_SIZE = 64 * 2**10
+# larger images take far too much memory to resize
+MAX_PIXELS = 50_000_000
+
+# directories and files that archivers add, which are never emotes
+JUNK_DIRECTORIES = {'__MACOSX'}
+JUNK_FILENAMES = {'.DS_Store', 'Thumbs.db', 'desktop.ini'}
+
+# width and height are None if they couldn't be found in the bytes given
+ImageHeader = collections.namedtuple('ImageHeader', 'mime_type width height')
+
+# JPEG start of frame markers, which are followed by the dimensions. C4, C8 and CC are other things
+SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+# JPEG markers which have no length or payload
+STANDALONE_MARKERS = frozenset(range(0xD0, 0xDA)) | {0x01}
+
+
+def is_junk(filename) -> bool:
+    """Return whether filename (a path inside an archive) is metadata added by an archiver or OS."""
+    *directories, basename = filename.replace('\\', '/').split('/')
+    if JUNK_DIRECTORIES.intersection(directories):
+        return True
+    # AppleDouble files, which hold the resource fork of the file of the same name without the ._
+    return basename in JUNK_FILENAMES or basename.startswith('._')
+
+
+def sniff(head: bytes) -> Optional[ImageHeader]:
+    """Return the type and dimensions of the image whose first bytes are head, or None if it's not an image.
+
+    Only GIF, PNG, JPEG and WEBP images are recognized.
+    """
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        width, height = _unpack('>II', head, 16)
+        return ImageHeader('image/png', width, height)
+    if head.startswith((b'GIF87a', b'GIF89a')):
+        width, height = _unpack('<HH', head, 6)
+        return ImageHeader('image/gif', width, height)
+    if head.startswith(b'\xFF\xD8\xFF'):
+        return ImageHeader('image/jpeg', *_jpeg_dimensions(head))
+    if head.startswith(b'RIFF') and head[8:12] == b'WEBP':
+        return ImageHeader('image/webp', *_webp_dimensions(head))
+    return None
+
+
+def pixels(header: ImageHeader) -> Optional[int]:
+    """Return how many pixels the image has, or None if its dimensions aren't known."""
+    if header.width is None or header.height is None:
+        return None
+    return header.width * header.height
+
+
+def _unpack(format, data, offset):
+    try:
+        return struct.unpack_from(format, data, offset)
+    except struct.error:
+        # the head was cut off before this field. every field we read is a single character in format
+        return (None,) * len(format.lstrip('<>'))
+
+
+def _jpeg_dimensions(head):
+    pos = 2
+    while pos + 4 <= len(head):
+        if head[pos] != 0xFF:
+            break
+        marker = head[pos + 1]
+        if marker == 0xFF:
+            # fill byte
+            pos += 1
+            continue
+        if marker in STANDALONE_MARKERS:
+            pos += 2
+            continue
+        if marker in SOF_MARKERS:
+            height, width = _unpack('>HH', head, pos + 5)
+            return width, height
+        if marker == 0xDA:
+            # start of scan: the image data follows, so there's no frame header
+            break
+        length, = struct.unpack_from('>H', head, pos + 2)
+        pos += 2 + length
+    return None, None
+
+
+def _webp_dimensions(head):
+    chunk = head[12:16]
+    if chunk == b'VP8 ':
+        width, height = _unpack('<HH', head, 26)
+        if width is None:
+            return None, None
+        return width & 0x3FFF, height & 0x3FFF
+    if chunk == b'VP8L':
+        bits, = _unpack('<I', head, 21)
+        if bits is None:
+            return None, None
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk == b'VP8X' and len(head) >= 30:
+        width = int.from_bytes(head[24:27], 'little') + 1
+        height = int.from_bytes(head[27:30], 'little') + 1
+        return width, height
+    return None, None
@@ -0,0 +1,152 @@
+# © lambda#0987 <lambda@lambda.dance>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+"""lightweight, sampled tracing of where the time in a command goes
+
+a trace is started with trace() around a command invocation. while it is active, span() (or functions decorated with
+traced()) record nested timings, which follow the code into tasks it creates, since asyncio tasks copy their context.
+when the trace ends, it is logged as a single JSON record. spans with the same name and parent are merged,
+so that a trace of an import of hundreds of emotes stays small.
+
+outside of a sampled trace, span() costs about as much as a context variable lookup.
+"""
+
+import asyncio
+import contextlib
+import contextvars
+import functools
+import json
+import logging
+import random
+import time
+
+logger = logging.getLogger(__name__)
+
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+
+class Span:
+    __slots__ = ('name', 'attrs', 'start', 'end', 'error', 'children')
+
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        self.start = time.perf_counter()
+        self.end = None
+        self.error = None
+        self.children = []
+
+
+@contextlib.contextmanager
+def _enter(span):
+    token = _current_span.set(span)
+    try:
+        yield span
+    except BaseException as exc:
+        span.error = type(exc).__name__
+        raise
+    finally:
+        span.end = time.perf_counter()
+        _current_span.reset(token)
+
+
+@contextlib.contextmanager
+def trace(name, *, sample_rate, **attrs):
+    """Trace the block, with probability sample_rate, logging the result when it exits.
+
+    Yields the root Span, or None if this invocation isn't sampled (or a trace is already active).
+    """
+    if _current_span.get() is not None or random.random() >= sample_rate:
+        yield None
+        return
+
+    root = Span(name, attrs)
+    try:
+        with _enter(root):
+            yield root
+    finally:
+        tree = render(root)
+        logger.info('trace %s', json.dumps(tree), extra={'trace': tree})
+
+
+@contextlib.contextmanager
+def span(name, **attrs):
+    """Record how long the block takes as a child of the current span, if a trace is active."""
+    parent = _current_span.get()
+    if parent is None:
+        yield None
+        return
+
+    child = Span(name, attrs)
+    parent.children.append(child)
+    with _enter(child):
+        yield child
+
+
+def annotate(**attrs):
+    """Add attributes to the current span, if a trace is active."""
+    current = _current_span.get()
+    if current is not None:
+        current.attrs.update(attrs)
+
+
+def traced(name=None):
+    """Decorator that wraps each call of a function or coroutine function in a span called name."""
+    def decorator(func):
+        span_name = name or func.__qualname__
+
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                if _current_span.get() is None:
+                    return await func(*args, **kwargs)
+                with span(span_name):
+                    return await func(*args, **kwargs)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if _current_span.get() is None:
+                    return func(*args, **kwargs)
+                with span(span_name):
+                    return func(*args, **kwargs)
+
+        return wrapper
+    return decorator
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 3)
+
+
+def render(root):
+    """Return a JSON serializable tree of the timings in root."""
+    return _render_group([root], root.end)
+
+
+def _render_group(spans, trace_end):
+    """render spans that share a name and a parent as one node."""
+    durations = [(span.end or trace_end) - span.start for span in spans]
+    node = {'name': spans[0].name}
+    if len(spans) == 1:
+        node.update(spans[0].attrs)
+        node['ms'] = _ms(durations[0])
+    else:
+        node['count'] = len(spans)
+        node['ms'] = _ms(sum(durations))
+        node['max_ms'] = _ms(max(durations))
+
+    unfinished = sum(span.end is None for span in spans)
+    if unfinished:
+        # still running in some other task when the trace ended
+        node['unfinished'] = unfinished
+    errors = [span.error for span in spans if span.error is not None]
+    if errors:
+        node['errors'] = errors if len(errors) <= 3 else len(errors)
+
+    groups = {}
+    for span in spans:
+        for child in span.children:
+            groups.setdefault(child.name, []).append(child)
+    if groups:
+        node['children'] = [_render_group(group, trace_end) for group in groups.values()]
+    return node